@@ -9,6 +9,10 @@ class Config(object):
                 'user': 'benhong',
                 'password': '',
                 'database': 'vizio'
+            },
+            # storage=sqlite, see vizio_storage
+            'vizio_sqlite':{
+                'path': './vizio.sqlite'
             }
         }
 
@@ -2,6 +2,10 @@ import logging
 from datetime import datetime
 
 import os
+import json
+import atexit
+import threading
+from Queue import Queue, Full
 
 # Trying something
 
@@ -64,12 +68,116 @@ class LocalBaseLogger(Singleton):
     ## -- END OF INITIALIZATION METHOD -- ##
 ## -- END OF CLASS -- ##
 
+# Structured formatter: one JSON object per line
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time':    self.formatTime(record, self.datefmt),
+            'created': record.created, # epoch seconds, for timings
+            'level':   record.levelname,
+            'logger':  record.name,
+            'thread':  record.threadName,
+            'message': record.getMessage()
+        }
+        # logger.info(msg, extra = {'fields': {...}}) adds structured fields
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default = str)
+## -- END OF CLASS -- ##
+
+# Asynchronous logging: records go to a bounded in-memory queue and a
+# listener thread writes them with the real handler.
+QUEUE_POLICIES = ['drop', 'block']
+
+class QueueHandler(logging.Handler):
+
+    def __init__(self, queue, policy = 'drop'):
+        # policy when the queue is full: 'drop' the record or 'block' until
+        # the listener makes room
+        if policy not in QUEUE_POLICIES:
+            raise ValueError('Unknown queue policy %s, drop or block'%policy)
+        logging.Handler.__init__(self)
+        self.queue   = queue
+        self.policy  = policy
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Format the message now; its arguments may change after this call
+        record.msg  = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            if self.policy == 'block':
+                self.queue.put(record)
+                return
+            if self.dropped:
+                # tell how many went missing, once there is room again
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name':      record.name,
+                    'levelno':   logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg':       '%s log records dropped, queue full'%self.dropped
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+## -- END OF CLASS -- ##
+
+class QueueListener(object):
+
+    _sentinel = None
+
+    def __init__(self, queue, handler):
+        self.queue   = queue
+        self.handler = handler
+        self.thread  = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        # write what is left in the queue when the process exits
+        atexit.register(self.stop)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            self.handler.handle(record)
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.queue.put(self._sentinel)
+            self.thread.join()
+        self.handler.close()
+## -- END OF CLASS -- ##
+
 # New Local Logger Class
 # Added on July 20, 2016: Enabled with NullHandler
 class LocalLogger(object):
 
     date_suffix_fmt = '%Y_%m_%d'
 
+    # Asynchronous mode, for every logger of the process. Loggers are made at
+    # import time, so the settings come from the environment:
+    #   VIZIO_LOG_ASYNC=drop|block  queue records, drop them or wait when full
+    #   VIZIO_LOG_QUEUE_SIZE=N      queue bound, 10000 by default
+    #   VIZIO_LOG_JSON=y            JsonFormatter instead of the text format
+    async_mode  = os.environ.get('VIZIO_LOG_ASYNC') or None
+    queue_size  = int(os.environ.get('VIZIO_LOG_QUEUE_SIZE', 10000))
+    json_format = os.environ.get('VIZIO_LOG_JSON', 'n').lower() == 'y'
+
     # Initialization method
     # Added on July 19, 2016: logsubdir is to give extra flexibility of logging
     def __init__(self, logger_name=None, logfile=None, logsubdir=None):
@@ -117,8 +225,18 @@ class LocalLogger(object):
 
         # If there was an error instantiate a Null Handler
         if self.err_msg is None:
-            self.formatter = logging.Formatter(fmt='[%(levelname)s] -- %(asctime)s :: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+            if self.json_format:
+                self.formatter = JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S')
+            else:
+                self.formatter = logging.Formatter(fmt='[%(levelname)s] -- %(asctime)s :: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
             self.handler.setFormatter(self.formatter)
+            if self.async_mode and not isinstance(self.handler, QueueHandler):
+                if self.async_mode not in QUEUE_POLICIES:
+                    raise ValueError('VIZIO_LOG_ASYNC=%s, drop or block'%self.async_mode)
+                # The file handler moves behind a queue and a listener thread
+                queue = Queue(maxsize = self.queue_size)
+                self.listener = QueueListener(queue, self.handler)
+                self.handler = QueueHandler(queue, policy = self.async_mode)
             self.logger.addHandler(self.handler)
             self.logger.setLevel(logging.DEBUG)
         else:
@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# Module loggers are made on import, keep their files out of /files2
+import local_logger
+local_logger.LocalBaseLogger.log_basedir = tempfile.mkdtemp(prefix = 'vizio_test_logs_')
+
+
+def viewing_row(household_id, start, end, zipcode = '10001', call_sign = 'WABC',
+                offset = 0):
+    # One line of a Vizio content file, on 2017-05-02
+    return ','.join([household_id,
+                     zipcode,
+                     'NEW YORK',
+                     'EP000001',
+                     'Show',
+                     '2017-05-02T10:00:00Z',
+                     call_sign,
+                     str(offset),
+                     '2017-05-02 ' + start,
+                     '2017-05-02 ' + end])
+
+
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    # The importer works in the current directory: the sqlite database of
+    # config.py, ./reference and ./vizio_temp
+    monkeypatch.chdir(str(tmpdir))
+    os.symlink(os.path.join(REPO_DIR, 'reference'), 'reference')
+    return tmpdir
+
+
+@pytest.fixture
+def write_part(workdir):
+    # write_part(name, rows) -> path of a content file of viewing_row lines
+    def write(name, rows):
+        path = str(workdir.join(name))
+        with open(path, 'w') as f:
+            f.write('\n'.join(rows) + '\n')
+        return path
+    return write
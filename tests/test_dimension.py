@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+from vizio_dimension import VizioDimension, key_hashes
+
+
+def networks(call_signs, ids):
+    return pd.DataFrame({'id': ids, 'call_sign': call_signs},
+                        columns = ['id', 'call_sign'])
+
+
+def test_key_hashes_nulls():
+    frame = pd.DataFrame({'a': ['x', None, np.nan]})
+    hashes = key_hashes(frame, ['a'])
+    assert hashes[1] == hashes[2]
+    assert hashes[0] != hashes[1]
+
+
+def test_lookup():
+    dim = VizioDimension(networks(['WABC', 'WGN'], [1, 2]), ['call_sign'])
+    dim.append(networks(['KQED'], [3]))
+    found = dim.lookup(pd.DataFrame({'call_sign': ['KQED', 'WXYZ', 'WABC']},
+                                    index = [5, 6, 7]))
+    assert list(found.index) == [5, 6, 7]
+    assert found.id.values[0] == 3
+    assert pd.isnull(found.id.values[1])
+    assert found.id.values[2] == 1
+    assert dim.max_id() == 3
+    assert len(dim) == 3
+
+
+def test_lookup_numeric_keys():
+    # stored as integers, looked up as objects with None
+    times = pd.DataFrame({'id': [1, 2], 'time_slot': [1, 2]}, columns = ['id', 'time_slot'])
+    dim = VizioDimension(times, ['time_slot'])
+    found = dim.lookup(pd.DataFrame({'time_slot': np.array([2, None, 1.5], dtype = object)}))
+    assert found.id.values[0] == 2
+    assert found.id.isnull().values[1:].all()
+
+
+def test_lookup_empty():
+    dim = VizioDimension(networks([], []), ['call_sign'])
+    found = dim.lookup(pd.DataFrame({'call_sign': ['WABC', 'WGN']}))
+    assert len(found) == 2
+    assert found.id.isnull().all()
+    assert not dim.contains([1, None]).any()
+    assert dim.max_id() is None
+
+
+def test_contains_objects():
+    dim = VizioDimension(networks(['WABC', 'WGN'], [1, 2]), ['call_sign'])
+    ids = np.array([1, None, 3, 2.0], dtype = object)
+    assert list(dim.contains(ids)) == [True, False, False, True]
+
+
+def test_set_values_and_take():
+    dim = VizioDimension(networks(['WABC', 'WGN', 'KQED'], [1, 2, 3]), ['call_sign'])
+    dim.set_values([2], 'call_sign', 'WGN-TV')
+    assert dim.lookup(pd.DataFrame({'call_sign': ['WGN-TV']})).id.values[0] == 2
+    dim.take(np.array([True, False, True]))
+    assert list(dim.column('id')) == [1, 3]
+    assert pd.isnull(dim.lookup(pd.DataFrame({'call_sign': ['WGN-TV']})).id.values[0])
@@ -0,0 +1,61 @@
+from datetime import date, datetime
+from conftest import viewing_row
+from vizio_fileinfo_registry import VizioFileInfoRegistry
+
+DATA_DATE = date(2017, 5, 2)
+
+
+def registry_rows():
+    registry = VizioFileInfoRegistry()
+    registry.load([
+        [1, 'part_00', DATA_DATE, datetime(2017, 5, 3), datetime(2017, 5, 3), None, None],
+        [2, 'part_01', DATA_DATE, datetime(2017, 5, 3), None, None, None],
+        [3, 'part_00_manifest', DATA_DATE, datetime(2017, 5, 3), None, None, None],
+        [4, 'part_02', date(2017, 5, 1), datetime(2017, 5, 2), None, None, None]
+    ])
+    return registry
+
+
+def test_pending_files():
+    registry = registry_rows()
+    assert len(registry) == 4
+    assert 'part_00_manifest' in registry
+    assert registry.files_for_date(DATA_DATE) == ['part_00', 'part_00_manifest', 'part_01']
+    assert registry.pending_files(DATA_DATE) == ['part_01']
+    assert registry.pending_files(date(2017, 5, 1)) == ['part_02']
+    assert registry.pending_files(date(2017, 5, 4)) == []
+
+
+def test_stage_and_written():
+    registry = registry_rows()
+    registry.stage('part_03', DATA_DATE, downloaded_date = datetime(2017, 5, 3))
+    registry.stage('part_01', date(2017, 5, 9), imported_date = datetime(2017, 5, 3),
+                   sample_rate = 0.1)
+    # existing files keep their date
+    assert registry.get('part_01')['data_date'] == DATA_DATE
+    assert registry.pending_files(DATA_DATE) == ['part_03']
+    assert registry.imported_sample_rates(DATA_DATE) == set([None, 0.1])
+    assert registry.imported_sample_rates(DATA_DATE, exclude = 'part_00') == set([0.1])
+    assert sorted(registry.pending) == ['part_01', 'part_03']
+
+    # staged rows keep the in-memory version when the table is read again
+    registry.load([[2, 'part_01', DATA_DATE, None, None, None, None]])
+    assert registry.get('part_01')['sample_rate'] == 0.1
+    registry.written({'part_03': 5})
+    assert registry.pending == {}
+    assert registry.get('part_03')['id'] == 5
+
+
+def test_import_pending_skips_manifests(write_part):
+    from vizio_main import import_pending
+    from vizio_data_import import VizioImporter
+    write_part('part_00', [viewing_row('hh1', '10:20:00', '10:40:00')])
+    write_part('part_00_manifest', ['{"entries": ["part_00"]}'])
+    vizio = VizioImporter(2017, 5, 2, storage = 'sqlite', reject_dir = './rejects')
+    for file_name in ['part_00', 'part_00_manifest']:
+        vizio.fileinfo_registry.stage(file_name, DATA_DATE,
+                                      downloaded_date = datetime(2017, 5, 3))
+    import_pending(vizio, '.', failures = {})
+    assert vizio.fileinfo_registry.get('part_00')['imported_date'] is not None
+    assert vizio.fileinfo_registry.get('part_00_manifest')['imported_date'] is None
+    assert vizio.fileinfo_registry.pending_files(DATA_DATE) == []
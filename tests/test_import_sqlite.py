@@ -0,0 +1,103 @@
+import sqlite3
+from conftest import viewing_row
+from vizio_data_import import VizioImporter
+
+FACT_TABLE = 'vizio_viewing_fact_2017_05_02'
+
+# two households, the second row crosses 10:30 and is split in two
+PART_ROWS = [
+    viewing_row('hh1', '10:00:00', '10:10:00'),
+    viewing_row('hh1', '10:20:00', '10:40:00', call_sign = 'WGN'),
+    viewing_row('hh2', '11:05:00', '11:20:00', zipcode = '94105'),
+    viewing_row('hh2', '11:35:00', '11:45:00', zipcode = '94105')
+]
+
+
+def importer(**options):
+    return VizioImporter(2017, 5, 2, storage = 'sqlite', reject_dir = './rejects',
+                         **options)
+
+
+def query(sql):
+    connection = sqlite3.connect('vizio.sqlite')
+    try:
+        return connection.execute(sql).fetchall()
+    finally:
+        connection.close()
+
+
+def test_import_file(write_part):
+    part = write_part('part_00', PART_ROWS)
+    vizio = importer()
+    vizio.import_file(part)
+    assert query('SELECT COUNT(*) FROM %s'%FACT_TABLE) == [(5, )]
+    assert query('SELECT COUNT(*) FROM vizio_activity_dim') == [(2, )]
+    assert vizio.fileinfo_registry.get('part_00')['imported_date'] is not None
+
+
+def test_bulk_day_import(write_part):
+    part = write_part('part_00', PART_ROWS)
+    vizio = importer(bulk_day = True)
+    vizio.import_file(part)
+    vizio.build_viewing_constraints()
+    assert query('SELECT COUNT(*) FROM %s'%FACT_TABLE) == [(5, )]
+    indexes = set(row[0] for row in query(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = '%s'"%FACT_TABLE
+    ))
+    assert 'ix_%s_viewing_start_time'%FACT_TABLE in indexes
+
+
+def test_household_filter_import(write_part):
+    # a fresh database: the activities are empty when the filter is loaded
+    part = write_part('part_00', PART_ROWS)
+    vizio = importer(household_filter_path = './household_filter.bloom')
+    vizio.import_file(part)
+    assert query('SELECT COUNT(*) FROM vizio_activity_dim') == [(2, )]
+
+    # next run, the activities are spilled: hh2 is known, hh3 is new
+    part = write_part('part_01', [
+        viewing_row('hh2', '12:00:00', '12:10:00', zipcode = '94105'),
+        viewing_row('hh3', '12:05:00', '12:40:00')
+    ])
+    vizio = importer(household_filter_path = './household_filter.bloom')
+    vizio.import_file(part)
+    assert query('SELECT household_id FROM vizio_activity_dim ORDER BY id') == [
+        ('hh1', ), ('hh2', ), ('hh3', )
+    ]
+    assert query('SELECT COUNT(*) FROM %s'%FACT_TABLE) == [(8, )]
+
+
+def test_day_batch_failures(write_part):
+    # the missing part fails to parse, the other one is still loaded
+    part     = write_part('part_00', PART_ROWS)
+    failures = {}
+    vizio    = importer(day_batch = True)
+    vizio.import_day(['./part_01', part], failures, max_failures = 2)
+    assert failures == {'part_01': 1}
+    assert query('SELECT COUNT(*) FROM %s'%FACT_TABLE) == [(5, )]
+
+    vizio.import_day(['./part_01'], failures, max_failures = 2)
+    vizio.import_day(['./part_01'], failures, max_failures = 2)
+    assert failures == {'part_01': 2}
+
+
+def test_sessions_merge_across_parts(write_part):
+    # the viewing of hh1 goes on in the next part; the halves of the :30
+    # splits end in the same slot, so they are merged back too
+    parts = [
+        write_part('part_00', [viewing_row('hh1', '10:40:00', '10:45:00'),
+                               viewing_row('hh2', '10:00:00', '10:35:00')]),
+        write_part('part_01', [viewing_row('hh1', '10:45:00', '10:50:00'),
+                               viewing_row('hh3', '11:20:00', '11:40:00')])
+    ]
+    vizio = importer(sessionize = True)
+    for part in parts:
+        vizio.import_file(part)
+    vizio.flush_sessions()
+    assert sorted(query(
+        'SELECT viewing_start_time, viewing_end_time, viewing_duration FROM %s'%FACT_TABLE
+    )) == [
+        ('2017-05-02 10:00:00.000000', '2017-05-02 10:35:00.000000', 2100),
+        ('2017-05-02 10:40:00.000000', '2017-05-02 10:50:00.000000', 600),
+        ('2017-05-02 11:20:00.000000', '2017-05-02 11:40:00.000000', 1200)
+    ]
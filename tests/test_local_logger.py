@@ -0,0 +1,16 @@
+import pytest
+from local_logger import LocalLogger, QueueHandler
+
+
+def test_queue_policies():
+    assert QueueHandler(None, policy = 'block').policy == 'block'
+    with pytest.raises(ValueError):
+        QueueHandler(None, policy = 'y')
+
+
+def test_unknown_async_mode(monkeypatch):
+    # VIZIO_LOG_ASYNC=y is not taken as drop
+    monkeypatch.setattr(LocalLogger, 'async_mode', 'y')
+    with pytest.raises(ValueError):
+        LocalLogger(logger_name = 'test_unknown_async_mode',
+                    logfile = 'test_unknown_async_mode.log')
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from vizio_memory import MmapDimension
+
+
+def activities(household_ids, ids):
+    return pd.DataFrame({'household_id':     household_ids,
+                         'id':               ids,
+                         'last_active_date': [None] * len(ids)},
+                        columns = ['household_id', 'id', 'last_active_date'])
+
+
+def test_lookup(tmpdir):
+    dim = MmapDimension(activities(['hh1', 'hh2'], [1, 2]), ['household_id'],
+                        ['last_active_date'], str(tmpdir), name = 'activities')
+    found = dim.lookup(pd.DataFrame({'household_id': ['hh2', 'hh3', 'hh1']}))
+    assert found.id.values[0] == 2
+    assert np.isnan(found.id.values[1])
+    assert found.id.values[2] == 1
+    assert list(dim.contains([1, 3, np.nan])) == [True, False, False]
+
+
+def test_lookup_empty(tmpdir):
+    dim = MmapDimension(activities([], []), ['household_id'],
+                        ['last_active_date'], str(tmpdir), name = 'activities')
+    frame = pd.DataFrame({'household_id': ['hh1', 'hh2']})
+    found = dim.lookup(frame, ['last_active_date'])
+    assert len(found) == 2
+    assert found.id.isnull().all()
+    assert found.last_active_date.isnull().all()
+    assert not dim.contains([1, 2]).any()
+
+    # rows appended after the spill are found in the delta
+    dim.append(activities(['hh2'], [1]))
+    found = dim.lookup(frame)
+    assert np.isnan(found.id.values[0])
+    assert found.id.values[1] == 1
+    assert list(dim.contains([1, 2])) == [True, False]
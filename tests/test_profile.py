@@ -0,0 +1,19 @@
+import os
+import time
+import pstats
+import threading
+from vizio_profile import VizioProfiler
+
+
+def writer():
+    time.sleep(0.2)
+
+
+def test_cpu_stage_waits_for_its_threads(tmpdir):
+    profiler = VizioProfiler('cpu', str(tmpdir))
+    with profiler.stage('import_facts', 'part_00'):
+        thread = threading.Thread(target = writer)
+        thread.start()
+    assert not thread.is_alive()
+    stats = pstats.Stats(os.path.join(str(tmpdir), 'part_00.import_facts.prof'))
+    assert 'writer' in [function for _, _, function in stats.stats]
@@ -0,0 +1,64 @@
+import numpy as np
+from vizio_sketch import HyperLogLog, BloomFilter
+
+# 1.04 / sqrt(2**12) standard error, tests allow three of them
+HLL_ERROR = 3 * 1.04 / np.sqrt(2 ** 12)
+
+
+def test_hll_count():
+    assert HyperLogLog().count() == 0
+    for n in [10, 1000, 100000]:
+        sketch = HyperLogLog().update(np.arange(n))
+        assert abs(sketch.count() - n) <= max(1, HLL_ERROR * n)
+
+
+def test_hll_duplicates():
+    sketch = HyperLogLog().update(np.arange(5000)).update(np.arange(5000))
+    assert abs(sketch.count() - 5000) <= HLL_ERROR * 5000
+
+
+def test_hll_merge():
+    # households seen on either of two networks
+    a = HyperLogLog().update(np.arange(0, 60000))
+    b = HyperLogLog().update(np.arange(40000, 100000))
+    assert abs(a.merge(b).count() - 100000) <= HLL_ERROR * 100000
+
+
+def test_hll_bytes():
+    sketch = HyperLogLog().update(np.arange(20000))
+    loaded = HyperLogLog.from_bytes(sketch.to_bytes())
+    assert loaded.count() == sketch.count()
+    assert (loaded.registers == sketch.registers).all()
+
+
+def households(start, end):
+    return np.array(['hh%08d'%x for x in range(start, end)], dtype = object)
+
+
+def test_bloom_error_rate():
+    bloom = BloomFilter.for_capacity(10000, error_rate = 0.01)
+    bloom.add(households(0, 10000))
+    # no false negatives, false positives around error_rate
+    assert bloom.contains(households(0, 10000)).all()
+    assert bloom.contains(households(10000, 110000)).mean() <= 0.02
+    assert not bloom.full()
+    bloom.add(households(10000, 10001))
+    assert bloom.full()
+
+
+def test_bloom_empty():
+    bloom = BloomFilter.for_capacity(0)
+    assert not bloom.contains(households(0, 100)).any()
+    assert len(bloom.contains(households(0, 0))) == 0
+
+
+def test_bloom_save_load(tmpdir):
+    path  = str(tmpdir.join('household_filter.npz'))
+    bloom = BloomFilter.for_capacity(1000).add(households(0, 500))
+    bloom.save(path, max_id = 500)
+    loaded, info = BloomFilter.load(path)
+    assert info == {'max_id': 500}
+    assert loaded.count == 500
+    assert loaded.contains(households(0, 500)).all()
+    assert (loaded.contains(households(500, 5000)) ==
+            bloom.contains(households(500, 5000))).all()
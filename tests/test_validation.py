@@ -0,0 +1,42 @@
+from conftest import viewing_row
+from vizio_validation import REJECT_REASON, read_viewing_data, validate_viewing_data
+
+
+def validate(tmpdir, rows):
+    path = str(tmpdir.join('part_00'))
+    with open(path, 'w') as f:
+        f.write('\n'.join(rows) + '\n')
+    return validate_viewing_data(read_viewing_data(path))
+
+
+def test_valid_rows(tmpdir):
+    data, rejects = validate(tmpdir, [
+        viewing_row('hh1', '10:00:00', '10:10:00', zipcode = '2134'),
+        viewing_row('hh2', '10:50:00', '11:10:00', zipcode = '94105.0'),
+    ])
+    assert len(rejects) == 0
+    assert list(data.zipcode) == ['02134', '94105']
+    assert data.program_time_at_start.dtype.kind == 'i'
+
+
+def test_reason_codes(tmpdir):
+    data, rejects = validate(tmpdir, [
+        viewing_row('hh1', '10:00:00', '10:10:00'),
+        viewing_row('', '10:00:00', '10:10:00'),
+        viewing_row('hh3', '10:00:00', 'soon'),
+        viewing_row('hh4', '10:00:00', '10:10:00', zipcode = 'ABCDE'),
+        viewing_row('hh5', '10:00:00', '10:10:00', offset = 'x12'),
+        viewing_row('hh6', '10:00:00', '10:10:00', offset = -5),
+        viewing_row('hh7', '10:10:00', '10:00:00', zipcode = '1234567'),
+    ])
+    assert list(data.household_id) == ['hh1']
+    assert list(rejects[REJECT_REASON]) == [
+        'missing_household_id',
+        'bad_timestamp_viewing_end_time',
+        'bad_zipcode',
+        'bad_offset',
+        'bad_offset',
+        'bad_zipcode|end_before_start'
+    ]
+    # rejects hold the values as given
+    assert list(rejects.program_time_at_start) == ['0', '0', '0', 'x12', '-5', '0']
@@ -9,7 +9,7 @@ csv_filename=$1
 
 mysql -ubenhong  <<QUERY_INPUT
 USE vizio;
-CREATE TABLE temp_to_update_activity LIKE vizio_activity_dim;
+CREATE TEMPORARY TABLE temp_to_update_activity LIKE vizio_activity_dim;
 ALTER TABLE temp_to_update_activity DROP COLUMN household_id;
 SET foreign_key_checks=0;
 SET unique_checks=0;
@@ -23,7 +23,7 @@ UPDATE vizio_activity_dim AS Original
 INNER JOIN temp_to_update_activity AS New USING(id)
 SET Original.last_active_date = New.last_active_date;
 COMMIT;
-DROP TABLE temp_to_update_activity;
+DROP TEMPORARY TABLE temp_to_update_activity;
 COMMIT;
 SET sql_log_bin=1;
 SET unique_checks=1;
@@ -1,10 +1,14 @@
 from time import time
 import pandas as pd
+import numpy as np
 import math
 import os
 import sys
 from datetime import datetime, date, timedelta
 from vizio_db_connection import VizioDBConnection
+from vizio_profile import VizioProfiler
+from vizio_validation import (VIEWING_COLUMNS, REJECT_REASON,
+                              read_viewing_data, validate_viewing_data)
 from local_logger import LocalLogger
 
 logger = LocalLogger(
@@ -17,6 +21,13 @@ logger = LocalLogger(
 class VizioImporter(VizioDBConnection):
     # 1. Initiate class by VizioImporter(year, month, day)
     # 2. use import_file mothod to import each file
+    #
+    # profile = 'cpu' or 'mem' profiles the stages of each file, see
+    # vizio_profile.VizioProfiler
+
+    def __init__(self, year, month, day, profile = None, **kwargs):
+        self.profiler = VizioProfiler(profile)
+        super(VizioImporter, self).__init__(year, month, day, **kwargs)
 
     def extend_viewing_data(self, viewing_data):
         # Split viewing_data to fit into time slots
@@ -109,94 +120,337 @@ class VizioImporter(VizioDBConnection):
         return extended_viewing_data
 
 
-    def import_file(self, filepath):
+    def sample_viewing_data(self, viewing_data):
+        # Rows of the households in the sample. A household is in it when the
+        # hash of its household_id falls under sample_rate, so it is in or out
+        # the same way on every file and day.
+        hashes = pd.util.hash_array(viewing_data.household_id.values.astype(object))
+        sampled = (hashes >> np.uint64(11)) < np.uint64(self.sample_rate * 2**53)
+        logger.info('Sampling %s of households. %s -> %s rows'%(self.sample_rate,
+                                                                len(viewing_data),
+                                                                sampled.sum()))
+        return viewing_data.loc[sampled].reset_index(drop = True)
+
+
+    def localize_viewing_data(self, dat):
+        # Local time slot and date of each row, from the tz_offset (hours) of
+        # its location. With whole-hour offsets the :00 and :30 splits of
+        # extend_viewing_data are local boundaries too; rows crossing a local
+        # boundary under any other offset are split there. Rows without an
+        # offset get no local slot.
+        offset = self.locations.lookup(dat, ['tz_offset']).tz_offset.values
+        dat['tz_offset'] = pd.to_numeric(pd.Series(offset)).astype(float).values
+        offset = pd.to_timedelta(dat.tz_offset * 3600, unit = 's')
+        local_start = dat.viewing_start_time + offset
+        boundary = local_start.dt.floor('30min') + pd.Timedelta(minutes = 30)
+        crossing = (dat.viewing_end_time + offset > boundary).values
+        if crossing.any():
+            split_at = (boundary - offset)[crossing].values
+            first  = dat.loc[crossing].copy()
+            second = first.copy()
+            first['viewing_end_time']    = split_at
+            second['viewing_start_time'] = split_at
+            second['program_time_at_start'] = (
+                second.program_time_at_start.values + (
+                    (second.viewing_start_time - dat.viewing_start_time[crossing])
+                    .dt.total_seconds() * 1000
+                ).astype(int).values
+            )
+            for part in [first, second]:
+                part['viewing_duration'] = (
+                    (part.viewing_end_time - part.viewing_start_time).dt.total_seconds()
+                ).astype(int)
+            dat = pd.concat([dat.loc[crossing == False], first, second],
+                            ignore_index = True)
+            offset = pd.to_timedelta(dat.tz_offset * 3600, unit = 's')
+
+        # Slot (1-48) and date by the end time, the rule time_slots applies
+        # to the UTC ones: a row ending right on :00 or :30 is in the next slot.
+        local_end = dat.viewing_end_time + offset
+        dat['local_time_slot'] = (local_end.dt.hour * 2
+                                  + (local_end.dt.minute >= 30) + 1)
+        dat['local_date'] = local_end.dt.date
+        return dat
+
+
+    def local_times(self, dat):
+        # time dimension rows of the local slots, aligned with dat
+        local = dat.loc[dat.local_time_slot.notnull(), ['local_time_slot', 'local_date']]
+        dates = pd.to_datetime(local.local_date)
+        times = pd.DataFrame({
+            'time_slot':   local.local_time_slot.astype(int).values,
+            'date':        local.local_date.values,
+            'day_of_week': (dates.dt.dayofweek + 1).values,
+            'week':        local.local_date.map(dict(
+                (x, x.isocalendar()[1]) for x in local.local_date.unique()
+            )).values,
+            'quarter':     dates.dt.quarter.values
+        }, index = local.index)
+        return times
+
+
+    def sessionize_viewing_data(self, dat, held):
+        # Merge consecutive segments of the same household, location, network,
+        # program and time slot. time_key goes by the end time, so the
+        # segments of a session all end in the half hour the merged row ends
+        # in and gets the time_key of. The halves of a split at :30 share a
+        # time_key already, so they are merged like the segments of a viewing
+        # that goes on in the next part. A segment continues the previous one
+        # if it starts at most session_gap_seconds after it ends.
+        # held are the segments held over from the previous part. Returns the
+        # merged rows to load and the segments of the latest hour, which the
+        # next part may continue (see hold_sessions).
+        keys = ['demographic_key',
+                'location_key',
+                'network_key',
+                'program_key',
+                'time_key',
+                'local_time_key']
+        rows = len(dat)
+        if held is not None and len(held):
+            dat = pd.concat([held, dat], ignore_index = True)
+        dat = dat.sort_values(keys + ['viewing_start_time']).reset_index(drop = True)
+
+        # new session on a new key, or a gap after the segments so far
+        key_values = dat[keys].fillna(-1)
+        new_key = (key_values != key_values.shift(1)).any(axis = 1).values
+        # epoch seconds
+        start   = dat.viewing_start_time.values.astype('datetime64[s]').astype('int64')
+        end     = pd.Series(
+            dat.viewing_end_time.values.astype('datetime64[s]').astype('int64')
+        )
+        group_end = end.groupby(new_key.cumsum()).cummax().shift(1).values
+        new_session = new_key | (start > group_end + self.session_gap_seconds)
+        new_session[0] = True
+
+        session_ids = new_session.cumsum()
+        merged = dat.loc[new_session].reset_index(drop = True)
+        merged['viewing_end_time'] = pd.to_datetime(
+            end.groupby(session_ids).max().values, unit = 's'
+        )
+        merged['viewing_duration'] = (
+            (merged.viewing_end_time - merged.viewing_start_time).dt.total_seconds()
+        ).astype(int)
+
+        # hold over the latest hour
+        hours = merged.viewing_start_time.dt.floor('60min')
+        latest = (hours == hours.max()).values
+        held   = merged.loc[latest].reset_index(drop = True)
+        merged = merged.loc[latest == False].reset_index(drop = True)
+        logger.info(
+            'Sessionizing Viewing_Data. %s rows + %s held over -> %s rows, %s held over'%(
+                rows,
+                len(dat) - rows,
+                len(merged),
+                len(held)
+            )
+        )
+        return merged, held
 
-        def __insertion_log(rows, table_name):
-            # Just do not want to repeat this over and over..
-            logger.info(
-                'Inserting {rows} rows to {table_name}'.format(
-                    rows = rows,
-                    table_name = table_name
-                )
+
+    def write_rejects(self, rejects, filepath):
+        # Rejected rows of filepath and their reason codes, one file per part.
+        # Re-importing the part overwrites it.
+        reject_path = os.path.join(
+            self.reject_dir,
+            self.current_date.strftime('%Y-%m-%d'),
+            self.fileinfo_name(filepath) + '.rejects.csv'
+        )
+        if len(rejects) == 0:
+            if os.path.isfile(reject_path):
+                os.remove(reject_path)
+            return
+        if not os.path.isdir(os.path.dirname(reject_path)):
+            os.makedirs(os.path.dirname(reject_path))
+        rejects.to_csv(reject_path, index = False)
+        logger.info('%s rejected rows written to %s'%(len(rejects), reject_path))
+
+
+    def insertion_log(self, rows, table_name):
+        # Just do not want to repeat this over and over..
+        logger.info(
+            'Inserting {rows} rows to {table_name}'.format(
+                rows = rows,
+                table_name = table_name
             )
+        )
+
 
+    def import_file(self, filepath):
         logger.info('Start importing - %s'%filepath)
         # reset threads list
         self.threads = []
 
+        with self.profiler.stage('parse_file', filepath):
+            viewing_data, rejects = self.parse_file(filepath)
+        with self.profiler.stage('resolve_dimensions', filepath):
+            self.resolve_dimensions(viewing_data)
+        with self.profiler.stage('import_facts', filepath):
+            self.import_facts(viewing_data, rejects, filepath)
+
+
+    def import_day(self, filepaths, failures = None, max_failures = 3):
+        # Day-batch mode. Every part is parsed first to gather the distinct
+        # natural keys of the day, which are resolved (new dimension rows
+        # inserted, activities updated) in one pass. Then the parts are
+        # parsed again one at a time and their facts loaded against the
+        # finished dimensions, so only one part is in memory at a time.
+        # With a failures dict (see vizio_main.import_pending), a part that
+        # fails to parse or load is counted and left out of the day instead
+        # of stopping the others, and skipped once it failed max_failures times.
+        self.threads = []
+        if failures is not None:
+            filepaths = [x for x in filepaths
+                         if not self.failed_too_often(x, failures, max_failures)]
+        logger.info('Start importing %s parts of %s'%(len(filepaths), self.current_date))
+        keys   = []
+        parsed = []
+        for filepath in filepaths:
+            try:
+                with self.profiler.stage('parse_file', filepath):
+                    viewing_data, _ = self.parse_file(filepath)
+            except Exception:
+                if failures is None:
+                    raise
+                self.count_failure(filepath, failures, max_failures)
+                continue
+            keys.append(self.natural_keys(viewing_data))
+            parsed.append(filepath)
+        if keys:
+            keys = self.natural_keys(pd.concat(keys, ignore_index = True))
+            logger.info('Resolving %s distinct key rows of the day'%len(keys))
+            with self.profiler.stage('resolve_dimensions', self.current_date):
+                self.resolve_dimensions(keys)
+        if not self.materialized_times:
+            # UTC and local slots of the day fall within a day of it
+            self.insert_times([self.current_date + timedelta(days = x)
+                               for x in [-1, 0, 1]])
+        self.join_threads()
+        self.clean_up_temp()
+
+        for filepath in parsed:
+            logger.info('Start importing - %s'%filepath)
+            self.threads = []
+            try:
+                with self.profiler.stage('reparse_file', filepath):
+                    viewing_data, rejects = self.parse_file(filepath)
+                with self.profiler.stage('import_facts', filepath):
+                    self.import_facts(viewing_data, rejects, filepath)
+            except Exception:
+                if failures is None:
+                    raise
+                self.count_failure(filepath, failures, max_failures)
+
+
+    def failed_too_often(self, filepath, failures, max_failures):
+        return failures.get(self.fileinfo_name(filepath), 0) >= max_failures
+
+
+    def count_failure(self, filepath, failures, max_failures):
+        # Log the failed import of a part and count it in failures
+        # (file name -> failed imports)
+        file_name = self.fileinfo_name(filepath)
+        failures[file_name] = failures.get(file_name, 0) + 1
+        logger.exception('Importing %s failed (%s of %s)'%(filepath,
+                                                         failures[file_name],
+                                                         max_failures))
+        if failures[file_name] >= max_failures:
+            logger.error('Skipping %s until restart, it failed %s times'%(filepath,
+                                                                        max_failures))
+
+
+    def natural_keys(self, viewing_data):
+        # Smallest set of actual rows covering every natural key of each
+        # dimension, so resolve_dimensions sees all of them
+        key_sets = [['household_id'],
+                    ['zipcode', 'dma'],
+                    ['call_sign'],
+                    ['tms_id', 'program_name', 'program_start_time']]
+        key_cols = sum(key_sets, [])
+        return pd.concat(
+            [viewing_data.drop_duplicates(key_set)[key_cols] for key_set in key_sets],
+            ignore_index = True
+        )
+
+
+    def parse_file(self, filepath):
+        # Valid (and sampled) rows of the file, and the rejected ones
         ### File Import
         if not os.path.isfile(filepath):
             logger.error('%s - not found '%filepath)
             raise IOError('%s - not found.'%filepath)
 
-        # columns given in the Vizio data
-        columns = [
-            'household_id',
-            'zipcode',
-            'dma',
-            'tms_id',
-            'program_name',
-            'program_start_time',
-            'call_sign',
-            'program_time_at_start',
-            'viewing_start_time',
-            'viewing_end_time'
-        ]
-        viewing_data = pd.read_csv(filepath,
-                                   names = columns,
-                                   header = None,
-                                   na_values = ['', 'null'])
-        #viewing_data = pd.read_csv(filepath, names = columns, na_values = ['', 'null'])
-        viewing_data.zipcode = [
-            "{:05d}".format(int(x)) if pd.isnull(x) == False else None
-            for x in viewing_data.zipcode
-        ]
-        viewing_data.program_start_time = [
-            x[:-1].replace('T', ' ') if pd.isnull(x) == False else None
-            for x in viewing_data.program_start_time
-        ]
-
-        for col in ['program_start_time', 'viewing_start_time', 'viewing_end_time']:
-            viewing_data[col] = pd.to_datetime(viewing_data[col])
+        # A date is loaded either in full or with one sample rate
+        other_rates = self.fileinfo_registry.imported_sample_rates(
+            self.current_date, exclude = self.fileinfo_name(filepath)
+        )
+        # fileinfo tables made before sample_rate was a double hold it in
+        # single precision (0.1 reads back as 0.100000001), hence the tolerance
+        other_rates = [x for x in other_rates
+                       if not (x == self.sample_rate or
+                               (x is not None and self.sample_rate is not None and
+                                abs(x - self.sample_rate) < 1e-6))]
+        if other_rates:
+            logger.error('%s already has files imported with sample rate %s'%(
+                self.current_date, ', '.join(str(x) for x in other_rates)))
+            raise ValueError('Sample rate differs from the imported files of the date')
+
+        raw_data = read_viewing_data(filepath)
+        viewing_data, rejects = validate_viewing_data(raw_data)
+        rejects = [rejects]
+        if len(rejects[0]):
+            logger.warning('%s of %s rows rejected in %s'%(len(rejects[0]),
+                                                           len(raw_data),
+                                                           filepath))
+        if self.sample_rate is not None:
+            viewing_data = self.sample_viewing_data(viewing_data)
         ### End of File Import
+        return viewing_data, rejects
 
+
+    def resolve_dimensions(self, viewing_data):
+        # Insert the dimension rows of the natural keys in viewing_data that
+        # are not in the dimensions yet, and update activities
         ### ACTIVITY & DEMOGRAPHICS
         all_demographics = pd.DataFrame(viewing_data.household_id.unique(),
                                         columns = ['household_id'])
-        in_activity_dim = pd.merge(
-            all_demographics,
-            self.activities,
-            on = 'household_id',
-            how = 'left',
-            indicator = True
+        # households the household filter has never seen are new for sure,
+        # only the others go through the exact lookup
+        known = self.known_households(all_demographics.household_id.values)
+        new_households  = all_demographics.loc[known == False]
+        all_demographics = all_demographics.loc[known].reset_index(drop = True)
+        if len(new_households):
+            logger.info('%s of %s households new by the household filter'%(
+                len(new_households), len(known)))
+        in_activity_dim = all_demographics.join(
+            self.activities.lookup(all_demographics, ['last_active_date'])
         )
         # households to insert to activity table and demographics table
-        insert_to_activity_demo = in_activity_dim[
-            (in_activity_dim['_merge'] == 'left_only')
-        ].copy()
+        insert_to_activity_demo = pd.concat([
+            new_households,
+            in_activity_dim[in_activity_dim.id.isnull()][['household_id']]
+        ], ignore_index = True)
         # households to update in activity table
         update_activity = in_activity_dim[
-            (in_activity_dim['_merge'] != 'left_only')
+            in_activity_dim.id.notnull()
         ].copy()
+        update_activity.id = update_activity.id.astype(int)
         # households to insert to demographics table
         insert_to_demo = update_activity.loc[
-            update_activity.id.isin(self.demographics.id) == False
+            self.demographics.contains(update_activity.id) == False
         ].copy()
         # households to update in activity table
-        update_activity = self.activities.loc[
-            (self.activities.id.isin(update_activity.id)) & \
-            (self.activities.last_active_date < self.current_date)
+        update_activity = update_activity.loc[
+            update_activity.last_active_date < self.current_date
         ].copy()
 
         if len(insert_to_activity_demo) > 0:
             # if household_id IS NOT found in BOTH Activity_Dim table and Demographic_Dim_{month}
-            __insertion_log(len(insert_to_activity_demo),
+            self.insertion_log(len(insert_to_activity_demo),
                             self.Activity.__tablename__)
-            __insertion_log(len(insert_to_activity_demo),
+            self.insertion_log(len(insert_to_activity_demo),
                             self.Demographic.__tablename__)
-            start_idx = 1
-            if len(self.activities):
-                start_idx = int(self.activities.id.max() + 1)
+            start_idx = (self.activities.max_id() or 0) + 1
             insert_to_activity_demo['last_active_date'] = [
                 self.current_date for _ in range(len(insert_to_activity_demo))
             ]
@@ -206,18 +460,16 @@ class VizioImporter(VizioDBConnection):
                 self.Activity,
                 insert_to_activity_demo.filter(self.ActivityCols)
             )
-            self.activities = pd.concat(
-                [self.activities,
-                 insert_to_activity_demo[['id',
-                                          'household_id',
-                                          'last_active_date']]],
-                ignore_index = True
+            self.activities.append(
+                insert_to_activity_demo[['id',
+                                         'household_id',
+                                         'last_active_date']]
             )
-            self.demographics = pd.concat(
-                [self.demographics,
-                 insert_to_activity_demo[['id',
-                                          'household_id']]],
-                ignore_index = True
+            if self.household_filter is not None:
+                self.household_filter.add(insert_to_activity_demo.household_id.values)
+            self.demographics.append(
+                insert_to_activity_demo[['id',
+                                         'household_id']]
             )
             self.raw_insert(
                 self.Demographic,
@@ -227,7 +479,7 @@ class VizioImporter(VizioDBConnection):
 
         if len(insert_to_demo) > 0:
             # if household_id IS found in Activity_Dim table, but NOT in Demographic_Dim_{month}
-            __insertion_log(len(insert_to_demo),
+            self.insertion_log(len(insert_to_demo),
                             self.Demographic.__tablename__)
             insert_to_demo = insert_to_demo.reset_index(drop=True)
             insert_to_demo.id = insert_to_demo.id.astype(int)
@@ -237,11 +489,9 @@ class VizioImporter(VizioDBConnection):
                 insert_to_demo[['id',
                                 'household_id']]
             )
-            self.demographics = pd.concat(
-                [self.demographics,
-                 insert_to_demo[['id',
-                                 'household_id']]],
-                ignore_index = True
+            self.demographics.append(
+                insert_to_demo[['id',
+                                'household_id']]
             )
 
         if len(update_activity) > 0:
@@ -262,10 +512,7 @@ class VizioImporter(VizioDBConnection):
         ### LOCATIONS
         loc_cols = ['zipcode',
                     'dma']
-        temp = pd.merge(viewing_data[loc_cols],
-                        self.locations[loc_cols],
-                        how='left',
-                        indicator=True)['_merge'] == 'left_only'
+        temp = self.locations.lookup(viewing_data).id.isnull()
         all_locations = viewing_data.loc[temp, loc_cols].drop_duplicates().dropna()
         all_locations = pd.merge(all_locations,
                                  self.zipcode_ref[['zipcode',
@@ -298,27 +545,24 @@ class VizioImporter(VizioDBConnection):
         self.all_locations = all_locations
 
         if len(all_locations) > 0:
-            __insertion_log(len(all_locations),
+            self.insertion_log(len(all_locations),
                             self.Location.__tablename__)
-            start_idx = 1
-            if len(self.locations):
-                start_idx = int(self.locations.id.max() + 1)
+            start_idx = (self.locations.max_id() or 0) + 1
             all_locations['id'] = range(start_idx, start_idx + len(all_locations))
             self.raw_insert(
                 self.Location,
                 all_locations[self.LocationCols]
             )
-            self.locations = pd.concat(
-                [self.locations,
-                 all_locations[['id',
-                                'zipcode',
-                                'dma']]]
-            )
+            new_locations = all_locations[['id',
+                                           'zipcode',
+                                           'dma']].copy()
+            new_locations['tz_offset'] = pd.to_numeric(all_locations.tz_offset).astype(float)
+            self.locations.append(new_locations)
         ### End of LOCATIONS
 
         ### NETWORK
         all_networks = viewing_data.loc[
-            viewing_data.call_sign.isin(self.networks.call_sign.unique()) == False,
+            self.networks.lookup(viewing_data).id.isnull(),
             ['call_sign']
         ].drop_duplicates()
         all_networks = pd.merge(
@@ -334,20 +578,17 @@ class VizioImporter(VizioDBConnection):
         self.all_networks = all_networks
 
         if len(all_networks) > 0:
-            __insertion_log(len(all_networks),
+            self.insertion_log(len(all_networks),
                             self.Network.__tablename__)
-            start_idx = 1
-            if len(self.networks):
-                start_idx = int(self.networks.id.max() + 1)
+            start_idx = (self.networks.max_id() or 0) + 1
             all_networks['id'] = range(start_idx, start_idx + len(all_networks))
             self.raw_insert(
                 self.Network,
                 all_networks.filter(self.NetworkCols)
             )
-            self.networks = pd.concat(
-                [self.networks,
-                 all_networks[['id',
-                               'call_sign']]]
+            self.networks.append(
+                all_networks[['id',
+                              'call_sign']]
             )
         ### End of NETWORKS
 
@@ -357,77 +598,67 @@ class VizioImporter(VizioDBConnection):
             'program_name',
             'program_start_time'
         ]
-        temp = pd.merge(
-            viewing_data[program_cols],
-            self.programs[program_cols],
-            how='left',
-            indicator=True
-        )['_merge'] == 'left_only'
+        temp = self.programs.lookup(viewing_data).id.isnull()
 
         all_programs = viewing_data.loc[temp, program_cols].drop_duplicates()
+        if self.program_window_days is not None and len(all_programs) > 0:
+            # Outside the cached window, but they may be in the table already
+            all_programs = self.resolve_programs(all_programs)
         all_programs = all_programs.where(pd.notnull(all_programs), None)
         all_programs.dropna(subset = ['tms_id'])
         self.all_programs = all_programs
 
         if len(all_programs) > 0:
-            __insertion_log(len(all_programs),
+            self.insertion_log(len(all_programs),
                             self.Program.__tablename__)
-            start_idx = 1
-            if len(self.programs):
-                start_idx = int(self.programs.id.max() + 1)
+            start_idx = int(self.program_max_id + 1)
             all_programs['id'] = range(start_idx, start_idx + len(all_programs))
+            self.program_max_id = start_idx + len(all_programs) - 1
             self.raw_insert(
                 self.Program,
                 all_programs.filter(self.ProgramCols)
             )
-            self.programs = pd.concat(
-                [self.programs,
+            self.programs.append(
                 all_programs[['id',
                               'tms_id',
                               'program_name',
-                              'program_start_time']]],
-                ignore_index = True
+                              'program_start_time']]
             )
         ### End of PROGRAMS
 
+
+    def import_facts(self, viewing_data, rejects, filepath):
+        # Fact rows of a parsed file, against the resolved dimensions
+        if self.sessionize and self.is_imported(filepath):
+            # Sessionized rows depend on the files before; only a file whose
+            # import did not finish can be replayed, see held_sessions
+            raise ValueError('%s is already imported, it cannot be imported again '
+                             'with sessionize'%filepath)
         ## Merge reference tables for the appropirate keys
+        self.profiler.snapshot('before_key_lookups', filepath)
         # demographic_key
-        temp = self.demographics.rename(index = str,
-                                        columns = {'id':'demographic_key'})
-        viewing_data = pd.merge(viewing_data,
-                                temp,
-                                on ='household_id',
-                                how = 'left')
-        if viewing_data.demographic_key.isnull().sum():
+        viewing_data['demographic_key'] = self.demographics.lookup(viewing_data).id.values
+        missing = viewing_data.demographic_key.isnull()
+        if missing.sum():
             logger.error('Missing household_id in %s'%filepath)
-            raise ValueError('Missing demographic_key')
+            missing_rows = viewing_data.loc[missing, VIEWING_COLUMNS].copy()
+            missing_rows[REJECT_REASON] = 'missing_demographic_key'
+            rejects.append(missing_rows)
+            viewing_data = viewing_data.loc[missing == False].reset_index(drop = True)
 
         # location_key
-        temp = self.locations.rename(index = str,
-                                     columns = {'id':'location_key'})
-        viewing_data = pd.merge(viewing_data,
-                                temp,
-                                on = ['zipcode', 'dma'],
-                                how = 'left')
+        viewing_data['location_key'] = self.locations.lookup(viewing_data).id.values
 
         # network_key
-        temp = self.networks.rename(index = str,
-                                    columns = {'id':'network_key'})
-        viewing_data = pd.merge(viewing_data,
-                                temp,
-                                on ='call_sign',
-                                how = 'left')
+        viewing_data['network_key'] = self.networks.lookup(viewing_data).id.values
 
         # program_key
-        temp = self.programs.rename(index = str,
-                                    columns = {'id':'program_key'})
-        viewing_data = pd.merge(viewing_data,
-                                temp,
-                                on = [ 'tms_id', 'program_name', 'program_start_time'],
-                                how = 'left')
+        viewing_data['program_key'] = self.programs.lookup(viewing_data).id.values
+        self.profiler.snapshot('after_key_lookups', filepath)
 
         ### Expand viewing data and place appropirate timeslots
         dat = self.extend_viewing_data(viewing_data)
+        self.profiler.snapshot('after_extend_viewing_data', filepath)
 
         # sometimes, these columns are interpreted as tuples
         for col in ['day_of_week', 'week']:
@@ -435,66 +666,105 @@ class VizioImporter(VizioDBConnection):
                 dat[col]       = [x[0] for x in dat[col]]
             except IndexError:
                 continue
+
+        # local time slots, next to the UTC ones
+        dat = self.localize_viewing_data(dat)
+        local_times = self.local_times(dat)
         ### End of Expand viewing data
 
         ### TIMES
-        all_times = dat.filter(self.TimeCols).drop_duplicates()
-        temp = pd.merge(
-            all_times,
-            self.times,
-            on = ['time_slot', 'date'],
-            how = 'left',
-            indicator = True
-        )['_merge'] == 'left_only'
-        all_times = all_times.reset_index(drop = True).loc[temp, ].drop_duplicates()
-        all_times = all_times.where(pd.notnull(all_times), None)
-
-        if len(all_times) > 0:
-            __insertion_log(len(all_times),
-                            self.Time.__tablename__)
-            start_idx = 1
-            if len(self.times):
-                start_idx = int(self.times.id.max() + 1)
-            all_times['id'] = range(start_idx, start_idx + len(all_times))
-            self.raw_insert(
-                self.Time,
-                all_times.filter(self.TimeCols)
-            )
-            self.times = pd.concat(
-                [self.times,
-                all_times[['id',
-                          'time_slot',
-                          'date']]],
-                ignore_index = True
+        if self.materialized_times:
+            # time_key straight from (date, time_slot), the time dimension
+            # is filled ahead of time by prepopulate_times
+            dat['time_key'] = self.lookup_time_keys(dat['date'], dat['time_slot'])
+            dat['local_time_key'] = np.nan
+            dat.loc[local_times.index, 'local_time_key'] = self.lookup_time_keys(
+                local_times['date'], local_times['time_slot']
             )
+        else:
+            all_times = pd.concat([dat.filter(self.TimeCols),
+                                   local_times.filter(self.TimeCols)],
+                                  ignore_index = True)
+            all_times = all_times.drop_duplicates(['time_slot', 'date']).reset_index(drop = True)
+            temp = self.times.lookup(all_times).id.isnull()
+            all_times = all_times.loc[temp, ].drop_duplicates()
+            all_times = all_times.where(pd.notnull(all_times), None)
+
+            if len(all_times) > 0:
+                self.insertion_log(len(all_times),
+                                self.Time.__tablename__)
+                start_idx = (self.times.max_id() or 0) + 1
+                all_times['id'] = range(start_idx, start_idx + len(all_times))
+                self.raw_insert(
+                    self.Time,
+                    all_times.filter(self.TimeCols)
+                )
+                self.times.append(
+                    all_times[['id',
+                               'time_slot',
+                               'date']]
+                )
         ### End of TIMES
 
         ### VIEWING
-        temp = self.times.rename(index = str,
-                                    columns = {'id':'time_key'})
-        dat = pd.merge(
-            dat,
-            temp,
-            on = ['time_slot', 'date'],
-            how = 'left'
-        )
+        if not self.materialized_times:
+            dat['time_key'] = self.times.lookup(dat).id.values
+            dat['local_time_key'] = np.nan
+            dat.loc[local_times.index, 'local_time_key'] = self.times.lookup(local_times).id.values
+        # Rows are tagged with their file; importing the file again
+        # replaces them instead of adding duplicates
+        source_file_id = self.source_file_id(filepath)
+        dat['source_file_id'] = source_file_id
+        if self.reach_sketches and len(dat):
+            # before sessionization, which holds rows over to the next file
+            self.sketches.update(dat)
+        if self.sessionize:
+            held = self.held_sessions(source_file_id)
+            if len(dat):
+                dat, held = self.sessionize_viewing_data(dat, held)
+            # rows merged with held over segments are loaded with this file,
+            # so they are tagged with it too
+            dat['source_file_id'] = source_file_id
+        fingerprints = self.viewing_fingerprints(dat)
         dat = dat.where(pd.notnull(dat), None)
-
-        __insertion_log(len(dat),
+        dat['row_fingerprint'] = fingerprints
+        duplicated = dat.row_fingerprint.duplicated()
+        if duplicated.sum():
+            logger.info('Dropping %s duplicated rows in %s'%(duplicated.sum(), filepath))
+            dat = dat.loc[duplicated == False]
+
+        if self.bulk_day:
+            # No foreign keys on the bare fact table, check them here instead
+            broken_keys = self.check_viewing_keys(dat)
+            if broken_keys.sum():
+                logger.error('%s rows with broken keys in %s'%(broken_keys.sum(),
+                                                               filepath))
+                raise ValueError('Broken foreign keys')
+
+        self.insertion_log(len(dat),
                         self.Viewing.__tablename__)
-        self.raw_insert(
-            self.Viewing,
-            dat.filter(self.ViewingCols)
+        self.load_viewing(
+            dat.filter(self.ViewingCols),
+            source_file_id = source_file_id
         )
         ### End of VIEWING
 
-        for thread in self.threads:
-            thread.join()
+        self.join_threads()
         self.clean_up_temp()
+        if self.sessionize:
+            # only once the rows of the file are in
+            self.hold_sessions(held, source_file_id)
+        self.write_rejects(pd.concat(rejects, ignore_index = True), filepath)
+
+        if self.reach_sketches:
+            self.flush_sketches()
 
         logger.info('Finished importing - %s'%filepath)
+        self.save_household_filter()
+        logger.info(self.enforce_memory_budget())
         self.update_fileinfo(filepath,
-                             imported_date = datetime.now())
+                             imported_date = datetime.now(),
+                             sample_rate = self.sample_rate)
 
 ### INGNORE ###
 def testing():
@@ -517,8 +787,9 @@ def testing():
             filepath = file_loc + file_name
             im.import_file(filepath)
             print time() - b, time() - a
-            if im.demographics.household_id.isnull().sum() + (im.demographics.household_id == '').sum() > 0:
-                im.demographics.to_csv('demo_problem_%s.csv'%file_name, index=False)
+            demographics = im.demographics.frame()
+            if demographics.household_id.isnull().sum() + (demographics.household_id == '').sum() > 0:
+                demographics.to_csv('demo_problem_%s.csv'%file_name, index=False)
 ### INGNORE ###
 
 def import_historical(folder_names):
@@ -539,9 +810,9 @@ def import_historical(folder_names):
         time_lst.append(time() - g_start)
 
         for file_name in files:
-            current_fileinfo = im.fileinfo.loc[im.fileinfo.file_name == file_name]
-            if (len(current_fileinfo) > 0 and
-                    current_fileinfo['imported_date'].isnull().sum() == 0):
+            current_fileinfo = im.fileinfo_registry.get(im.fileinfo_name(file_name))
+            if (current_fileinfo is not None and
+                    current_fileinfo['imported_date'] is not None):
                 continue
             start = time()
             print '##################### %s ###################'%file_name
@@ -6,56 +6,183 @@ import math
 import os
 import sys
 import threading
-from uuid import uuid4
+import gc
 from datetime import datetime, date, timedelta
-from sqlalchemy import create_engine
+from sqlalchemy import inspect, bindparam, func, or_, and_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, load_only
 from vizio_models import VizioViewingFact, VizioDemographicDim, VizioLocationDim, \
                          VizioNetworkDim, VizioProgramDim, VizioTimeDim, \
-                         VizioActivityDim, VizioFileInfo
+                         VizioActivityDim, VizioFileInfo, VizioReachSketch, \
+                         VIEWING_FACT_INDEXES, VIEWING_FACT_SOURCE_INDEX, \
+                         viewing_fact_index_name, \
+                         viewing_fact_foreign_keys
+from vizio_fileinfo_registry import VizioFileInfoRegistry
+from vizio_memory import MemoryBudget, MmapDimension, key_hashes
+from vizio_dimension import VizioDimension
+from vizio_sketch import HyperLogLog, VizioReachSketches, BloomFilter
+from vizio_storage import storage_backend
+from local_logger import LocalLogger
+
+logger = LocalLogger(
+            logger_name = __name__,
+            logfile = 'vizio_db_connection_{0}.log'.format(
+                datetime.today().strftime(LocalLogger.date_suffix_fmt)
+            )
+        ).logger
 
 class VizioDBConnection(object):
     # 1. Initiate class by VizioDBConnection(year, month, day)
 
-    def __init__(self, year, month, day, load_references = True):
-        # dynamic list of threads that will interact with different tables
+    # Natural key of each dimension
+    dimension_keys = {
+        'activities':   ['household_id'],
+        'demographics': ['household_id'],
+        'locations':    ['zipcode', 'dma'],
+        'networks':     ['call_sign'],
+        'programs':     ['tms_id', 'program_name', 'program_start_time'],
+        'times':        ['time_slot', 'date']
+    }
+
+    # Fact columns that make up row_fingerprint
+    fingerprint_cols = ['demographic_key',
+                        'location_key',
+                        'network_key',
+                        'program_key',
+                        'time_key',
+                        'local_time_key',
+                        'program_time_at_start',
+                        'viewing_start_time',
+                        'viewing_end_time']
+
+    # Smallest household filter, in households (1% false positives)
+    household_filter_min_capacity = 1000000
+
+    # Dimensions that may be spilled to disk under a memory budget:
+    # name -> (columns kept besides id, datetime key columns)
+    spillable_dimensions = {
+        'activities':   (['last_active_date'], []),
+        'demographics': ([], []),
+        'programs':     (['program_start_time'], ['program_start_time'])
+    }
+
+    def __init__(self, year, month, day, load_references = True,
+                 batch_activity_updates = False, activity_flush_threshold = None,
+                 bulk_day = False, parallel_references = True,
+                 program_window_days = None, materialized_times = False,
+                 memory_budget_mb = None, spill_dir = './vizio_spill',
+                 reject_dir = '/files2/Vizio/data/rejects',
+                 sessionize = False, session_gap_seconds = 0,
+                 reach_sketches = False, fact_shards = 1,
+                 fact_shard_min_rows = 100000, shard_retries = 2,
+                 sample_rate = None, day_batch = False, storage = 'mysql',
+                 household_filter_path = None, session_dir = './vizio_sessions',
+                 create_tables = True):
+        # dynamic list of threads that will interact with different tables,
+        # and what they raised (see to_thread, join_threads)
         self.threads = []
+        self.thread_errors = []
+
+        # Per-thread state, holds the session of __db_session
+        self.local = threading.local()
+        self.parallel_references = parallel_references
+
+        # Program cache. With program_window_days, self.programs only holds
+        # programs starting within that many days of the current date.
+        self.program_window_days = program_window_days
+
+        # Materialized time dimension. vizio_time_dim is filled for whole
+        # years and time_key is an array lookup on (date, time_slot).
+        self.materialized_times = materialized_times
+
+        # Memory budget. Over budget, the largest spillable dimensions move
+        # to memory-mapped files under spill_dir, see enforce_memory_budget.
+        self.memory_budget = MemoryBudget(memory_budget_mb)
+        self.spill_dir     = spill_dir
+
+        # Rows failing validation go to reject files under reject_dir/<date>
+        self.reject_dir = reject_dir
+
+        # Sessionization. Consecutive segments of one household on the same
+        # network and program within a time slot are merged into one fact
+        # row. Segments of the hour still being delivered are held over in
+        # session_buffer and merged with the next file; flush_sessions()
+        # inserts what is left at the end of the day. The buffer is saved
+        # under session_dir after each file, see hold_sessions. A file that
+        # finished importing cannot be imported again with sessionize, only
+        # one whose import was cut short.
+        self.sessionize          = sessionize
+        self.session_gap_seconds = session_gap_seconds
+        self.session_dir         = session_dir
+        self.session_buffer      = None # None until loaded for the date
+        self.session_file_id     = None # file the buffer was held after
+        self.previous_sessions   = (None, None) # (file id, buffer) before it
+
+        # Reach sketches. HyperLogLog sketches of demographic_key per
+        # network, program and time slot of the date, see vizio_sketch.
+        self.reach_sketches = reach_sketches
+        self.sketches       = None
+
+        # Fact loading. Batches of fact_shard_min_rows rows or more are
+        # split into fact_shards shards loaded in parallel, see load_viewing.
+        self.fact_shards         = fact_shards
+        self.fact_shard_min_rows = fact_shard_min_rows
+        self.shard_retries       = shard_retries
+
+        # Household sampling. With a sample_rate, only that stable fraction
+        # of household_ids is imported, see VizioImporter.sample_viewing_data
+        self.sample_rate = sample_rate
+
+        # Day-batch mode. The parts of a day are imported together by
+        # VizioImporter.import_day, resolving dimensions once.
+        self.day_batch = day_batch
+
+        # Household filter. With a household_filter_path, a Bloom filter of
+        # the household_ids in vizio_activity_dim is kept there between runs;
+        # households it has never seen skip the exact activity lookup.
+        self.household_filter_path = household_filter_path
+        self.household_filter      = None
+
+        # Activity updates. When batched, touched activity ids are gathered
+        # in memory and flushed as one deduplicated update at the end of the
+        # day (or run), or once activity_flush_threshold ids are pending.
+        self.batch_activity_updates   = batch_activity_updates
+        self.activity_flush_threshold = activity_flush_threshold
+        self.pending_activity_ids     = set()
+
+        # Bulk-day mode. The daily fact table is created bare and its indexes
+        # and foreign keys are built by build_viewing_constraints() once the
+        # day is loaded.
+        self.bulk_day = bulk_day
 
         # create temp folder to save files
         if not os.path.isdir('./vizio_temp'):
             os.mkdir('vizio_temp')
 
-        # SQLalchemy initializtion
+        # SQLalchemy initializtion. The storage backend ('mysql' or 'sqlite')
+        # makes the engine and does the bulk writes, see vizio_storage.
         self.config  = Config()
-        self.engine  = create_engine(
-            "mysql+mysqldb://{user}:{password}@{host}:{port}/{database}".format(
-                **self.config.CONNECTIONS['vizio']
-            )
-        )
+        self.storage = storage_backend(storage, self.config)
+        self.engine  = self.storage.create_engine()
         self.Session = sessionmaker(bind = self.engine)
         self.Base    = declarative_base()
 
-        # Date of the data
-        self.year          = year
-        self.month         = month
-        self.day           = day
-        self.current_date  = date(year, month, day)
+        # In-memory index of vizio_fileinfo, filled by load_fileinfo
+        self.fileinfo_registry = VizioFileInfoRegistry()
+
+        # Date-bound tables are declared once per date and reused by set_date
+        self.date_tables = {}
 
         # Tables
-        self.Viewing     = VizioViewingFact(self.Base, self.year,
-                                            self.month, self.day)
-        self.Demographic = VizioDemographicDim(self.Base, self.year, self.month)
         self.Activity    = VizioActivityDim(self.Base)
         self.Location    = VizioLocationDim(self.Base)
         self.Network     = VizioNetworkDim(self.Base)
         self.Program     = VizioProgramDim(self.Base)
         self.Time        = VizioTimeDim(self.Base)
         self.FileInfo    = VizioFileInfo(self.Base)
+        self.ReachSketch = VizioReachSketch(self.Base)
 
         # Columns
-        self.ViewingCols     = [col.key for col in self.Viewing.__table__.c]
-        self.DemographicCols = [col.key for col in self.Demographic.__table__.c]
         self.ActivityCols    = [col.key for col in self.Activity.__table__.c]
         self.LocationCols    = [col.key for col in self.Location.__table__.c]
         self.NetworkCols     = [col.key for col in self.Network.__table__.c]
@@ -63,8 +190,17 @@ class VizioDBConnection(object):
         self.TimeCols        = [col.key for col in self.Time.__table__.c]
         self.FileInfoCols    = [col.key for col in self.FileInfo.__table__.c]
 
-        # Initialize tables
-        self.Base.metadata.create_all(self.engine, checkfirst=True)
+        # Date of the data + Viewing and Demographic tables of that date
+        self.bind_date(year, month, day)
+
+        # Initialize tables. Read-only users (the exporter) leave them as is.
+        # create_all skips tables that exist, columns added to the models
+        # since they were made are added by add_missing_columns.
+        self.create_tables = create_tables
+        if self.create_tables:
+            self.Base.metadata.create_all(self.engine, checkfirst=True)
+            self.add_missing_columns(self.FileInfo)
+            self.upgrade_viewing_table()
 
         # Initialize reference Tables
         if load_references:
@@ -72,15 +208,46 @@ class VizioDBConnection(object):
 
 
     def initialize_references(self):
-        # Demographics Table
-        self.load_demographics()
+        # Dimension tables and reference files are loaded concurrently, each
+        # on its own thread and session, unless parallel_references is off.
+        loaders = [
+            self.load_demographics,   # Demographics Table
+            self.load_activities,     # Activities Table
+            self.load_locations,      # Location Table
+            self.load_zipcode_ref,    # zipcode-to-timezone reference csv file
+            self.load_networks,       # Network Table
+            self.load_call_signs_ref, # call sign reference file
+            self.load_programs,       # Program Table
+            self.load_times,          # Time Table
+            self.load_fileinfo        # Fileinfo Table
+        ]
+        if self.reach_sketches:
+            loaders.append(self.load_sketches) # Reach sketches of the date
+        if self.parallel_references:
+            self.run_parallel(loaders)
+        else:
+            for loader in loaders:
+                loader()
+
+        # Needs the activities, before any of them are spilled. With the
+        # filter, only households it may know are looked up in activities,
+        # so these are spilled to disk: the exact check becomes a binary
+        # search of the mapped key hashes instead of a resident frame.
+        # An empty table has nothing to spill, the memory budget may still
+        # spill it later on.
+        if self.household_filter_path:
+            self.load_household_filter()
+            if len(self.activities):
+                self.spill_dimension('activities')
+
+        # Datetime table and TimeSlot table
+        self.build_datetimes()
 
-        # Activities Table
-        self.load_activities()
+        if self.materialized_times:
+            self.prepopulate_times([self.year])
 
-        # Location Table + Load zipcode-to-timezone reference csv file
-        self.load_locations()
 
+    def load_zipcode_ref(self):
         zipcode_ref = pd.read_csv('./reference/zipcode_with_tz.csv')
         zipcode_ref.zipcode = [
             "{:05d}".format(int(x)) if pd.isnull(x) == False else x
@@ -92,27 +259,69 @@ class VizioDBConnection(object):
         zipcode_ref['zipcode_2'] = [x[:2] for x in zipcode_ref.zipcode]
         self.zipcode_ref = zipcode_ref
 
-        # Network Table + Load reference csv file
-        self.load_networks()
-        #self.call_signs_ref = pd.read_csv('./reference/vizio_to_fcc_callsign.csv')
-        self.call_signs_ref = pd.read_excel('./reference/Inscape_Active_Stations_6_6_17.xlsx')
-        self.call_signs_ref.columns = ['station_type',
-                                       'station_dma',
-                                       'network_affiliate',
-                                       'call_sign',
-                                       'station_name']
-        self.call_signs_ref = self.call_signs_ref.drop_duplicates()
 
-        # Program Table
-        self.load_programs()
+    def load_call_signs_ref(self):
+        #call_signs_ref = pd.read_csv('./reference/vizio_to_fcc_callsign.csv')
+        call_signs_ref = pd.read_excel('./reference/Inscape_Active_Stations_6_6_17.xlsx')
+        call_signs_ref.columns = ['station_type',
+                                  'station_dma',
+                                  'network_affiliate',
+                                  'call_sign',
+                                  'station_name']
+        self.call_signs_ref = call_signs_ref.drop_duplicates()
 
-        # Time Table
-        self.load_times()
 
-        # Fileinfo Table
-        self.load_fileinfo()
+    def bind_date(self, year, month, day):
+        # Date of the data
+        self.year          = year
+        self.month         = month
+        self.day           = day
+        self.current_date  = date(year, month, day)
+        self.viewing_max_id = None # see next_viewing_ids
 
-        # Datetime table and TimeSlot table
+        # Tables
+        key = (year, month, day)
+        if key not in self.date_tables:
+            demographic_key = (year, month)
+            if demographic_key not in self.date_tables:
+                self.date_tables[demographic_key] = VizioDemographicDim(
+                    self.Base, year, month
+                )
+            self.date_tables[key] = VizioViewingFact(self.Base, year,
+                                                     month, day,
+                                                     deferred = self.bulk_day)
+        self.Viewing     = self.date_tables[key]
+        self.Demographic = self.date_tables[(year, month)]
+
+        # Columns
+        self.ViewingCols     = [col.key for col in self.Viewing.__table__.c]
+        self.DemographicCols = [col.key for col in self.Demographic.__table__.c]
+
+
+    def set_date(self, year, month, day):
+        # Move a warm connection to another date without reloading everything.
+        # Pending activity updates belong to the old date, so flush them first.
+        self.flush_activity_updates()
+        self.flush_sessions()
+        self.join_threads()
+        self.clean_up_temp()
+        if self.reach_sketches:
+            self.flush_sketches()
+
+        month_changed = (year, month) != (self.year, self.month)
+        self.bind_date(year, month, day)
+        if self.create_tables:
+            self.Base.metadata.create_all(self.engine, checkfirst=True)
+            self.upgrade_viewing_table()
+        if month_changed:
+            self.load_demographics()
+        self.build_datetimes()
+        self.evict_programs()
+        if self.reach_sketches:
+            self.load_sketches()
+
+
+    def build_datetimes(self):
         datetimes  = {}
         time_slots = {}
         datetime_str = '{year}-{month}-{day}'.format(year  = self.year,
@@ -136,12 +345,23 @@ class VizioDBConnection(object):
 
     def __db_session(func):
         # wrapper around database operations. Open and close session when needed
+        # Sessions are kept per thread, so decorated methods can run concurrently.
         def wrapped(self, *args, **kwargs) :
-            self.session = self.Session()
-            func(self, *args, **kwargs)
-            self.session.close()
+            outer_session = getattr(self.local, 'session', None)
+            self.local.session = self.Session()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.local.session.close()
+                self.local.session = outer_session
         return wrapped
 
+
+    @property
+    def session(self):
+        # session of the current thread, opened by __db_session
+        return self.local.session
+
     ######### QUERIES to load lookup tables to match keys to metadata #########
     @__db_session
     def load_demographics(self):
@@ -156,7 +376,7 @@ class VizioDBConnection(object):
                                     columns = ['id',
                                                'household_id'])
         demographics.id = demographics.id.astype(int)
-        self.demographics = demographics
+        self.demographics = VizioDimension(demographics, self.dimension_keys['demographics'])
 
 
     @__db_session
@@ -174,7 +394,7 @@ class VizioDBConnection(object):
                                              'household_id',
                                              'last_active_date'])
         activities.id = activities.id.astype(int)
-        self.activities = activities
+        self.activities = VizioDimension(activities, self.dimension_keys['activities'])
 
 
     @__db_session
@@ -184,17 +404,21 @@ class VizioDBConnection(object):
         locations = []
 
         for row in self.session.query(
-                        self.Location).options(load_only('id', 'zipcode', 'dma')):
+                        self.Location).options(load_only('id', 'zipcode', 'dma', 'tz_offset')):
             locations.append([row.id,
                               row.zipcode,
-                              row.dma])
+                              row.dma,
+                              row.tz_offset])
 
         locations = pd.DataFrame(locations,
                                  columns = ['id',
                                             'zipcode',
-                                            'dma'])
+                                            'dma',
+                                            'tz_offset'])
         locations.id = locations.id.astype(int)
-        self.locations = locations
+        # hours, NaN when unknown
+        locations.tz_offset = pd.to_numeric(locations.tz_offset).astype(float)
+        self.locations = VizioDimension(locations, self.dimension_keys['locations'])
 
 
     @__db_session
@@ -212,16 +436,25 @@ class VizioDBConnection(object):
                                 columns = ['id',
                                            'call_sign'])
         networks.id = networks.id.astype(int)
-        self.networks = networks
+        self.networks = VizioDimension(networks, self.dimension_keys['networks'])
 
 
     @__db_session
     def load_programs(self):
         # Oddly, One tms_id can have more than one start_time
         # (tms_id, program_name, program_start_tie) for mapping
+        # With program_window_days, only programs starting within the window
+        # (and ones without a start time) are loaded; see resolve_programs.
         programs = []
 
-        for row in self.session.query(self.Program):
+        query = self.session.query(self.Program)
+        if self.program_window_days is not None:
+            window_start, window_end = self.program_window()
+            query = query.filter(or_(
+                self.Program.program_start_time.between(window_start, window_end),
+                self.Program.program_start_time == None
+            ))
+        for row in query:
             programs.append([row.id,
                              row.tms_id,
                              row.program_name,
@@ -234,7 +467,68 @@ class VizioDBConnection(object):
                                            'program_name',
                                            'program_start_time'])
         programs.id = programs.id.astype(int)
-        self.programs = programs
+        programs.program_start_time = pd.to_datetime(programs.program_start_time)
+        self.programs = VizioDimension(programs, self.dimension_keys['programs'])
+
+        # New program ids continue from the table, not from the cache
+        self.program_max_id = self.session.query(func.max(self.Program.id)).scalar() or 0
+
+
+    def program_window(self):
+        window = timedelta(days = self.program_window_days)
+        window_start = datetime.combine(self.current_date, datetime.min.time()) - window
+        window_end   = window_start + 2 * window + timedelta(days = 1)
+        return window_start, window_end
+
+
+    @__db_session
+    def resolve_programs(self, candidates):
+        # candidates are (tms_id, program_name, program_start_time) rows not
+        # found in the cached window. Looks them up in the table, adds the
+        # ones found to self.programs and returns the ones that are new.
+        program_cols = ['tms_id', 'program_name', 'program_start_time']
+        found = []
+        tms_ids = [x for x in candidates.tms_id.unique() if pd.isnull(x) == False]
+        names   = candidates.loc[candidates.tms_id.isnull(), 'program_name'].unique().tolist()
+        filters = []
+        for idx in range(0, len(tms_ids), 1000):
+            filters.append(self.Program.tms_id.in_(tms_ids[idx:idx + 1000]))
+        for idx in range(0, len(names), 1000):
+            filters.append(and_(self.Program.tms_id == None,
+                                self.Program.program_name.in_(names[idx:idx + 1000])))
+        for condition in filters:
+            for row in self.session.query(self.Program).filter(condition):
+                found.append([row.id,
+                              row.tms_id,
+                              row.program_name,
+                              row.program_start_time])
+        found = pd.DataFrame(found, columns = ['id'] + program_cols)
+        found.program_start_time = pd.to_datetime(found.program_start_time)
+        found = pd.merge(found, candidates[program_cols], on = program_cols)
+        if len(found):
+            found.id = found.id.astype(int)
+            self.programs.append(found)
+
+        missing = pd.merge(candidates,
+                           found[program_cols],
+                           how = 'left',
+                           indicator = True)
+        missing = missing[missing['_merge'] == 'left_only']
+        return missing[program_cols].reset_index(drop = True)
+
+
+    def evict_programs(self):
+        # Drop cached programs that started outside the window. Programs
+        # without a start time never leave the cache.
+        if self.program_window_days is None:
+            return
+        window_start, window_end = self.program_window()
+        start_time = pd.to_datetime(pd.Series(self.programs.column('program_start_time')))
+        in_window = (
+            start_time.isnull() |
+            ((start_time >= window_start) & (start_time <= window_end))
+        )
+        self.programs.take(in_window.values)
 
 
     @__db_session
@@ -251,11 +545,12 @@ class VizioDBConnection(object):
                                         'time_slot',
                                         'date'])
         times.id = times.id.astype(int)
-        self.times = times
+        self.times = VizioDimension(times, self.dimension_keys['times'])
 
 
     @__db_session
     def load_fileinfo(self, file_name = None):
+        # Rows go to the in-memory registry, see VizioFileInfoRegistry
         fileinfo = []
         query = self.session.query(self.FileInfo)
         if file_name:
@@ -266,96 +561,642 @@ class VizioDBConnection(object):
                              row.data_date,
                              row.downloaded_date,
                              row.imported_date,
-                             row.revised_date])
+                             row.revised_date,
+                             row.sample_rate])
+        self.fileinfo_registry.load(fileinfo)
 
-        fileinfo = pd.DataFrame(fileinfo,
-                                 columns = ['id',
-                                            'file_name',
-                                            'data_date',
-                                            'downloaded_date',
-                                            'imported_date',
-                                            'revised_date'])
-        fileinfo.id = fileinfo.id.astype(int)
-        if file_name and len(self.fileinfo):
-            if len(self.fileinfo.loc[self.fileinfo.file_name == file_name]):
-                for col in fileinfo.columns:
-                    if col in self.fileinfo:
-                        self.fileinfo.loc[self.fileinfo.file_name == file_name, col] = fileinfo[col].values[0]
-                        fileinfo = self.fileinfo
-            else:
-                fileinfo = pd.concat([self.fileinfo, fileinfo])
-        self.fileinfo = fileinfo
+
+    @property
+    def fileinfo(self):
+        # DataFrame view of the registry. Use fileinfo_registry for lookups.
+        return self.fileinfo_registry.to_frame()
 
     ######### END of QUERIES  #########
 
+    ######### Schema upgrade modules #########
+    @__db_session
+    def add_missing_columns(self, table_obj):
+        # Add the columns of the model that an existing table lacks, as
+        # nullable columns. Returns their names.
+        table_name = table_obj.__tablename__
+        inspector  = inspect(self.engine)
+        if table_name not in inspector.get_table_names():
+            return []
+        existing = set(col['name'] for col in inspector.get_columns(table_name))
+        added = []
+        for col in table_obj.__table__.c:
+            if col.key in existing:
+                continue
+            logger.info('Adding column %s to %s'%(col.key, table_name))
+            self.session.execute(
+                'ALTER TABLE {table_name} ADD COLUMN {column} {column_type} NULL'.format(
+                    table_name  = table_name,
+                    column      = col.key,
+                    column_type = col.type.compile(dialect = self.engine.dialect))
+            )
+            added.append(col.key)
+        self.session.commit()
+        return added
+
+
+    @__db_session
+    def upgrade_viewing_table(self):
+        # Daily fact tables made before rows were tagged with their file lack
+        # source_file_id and row_fingerprint, which every load writes and
+        # replays delete by, and the ones made before local time slots lack
+        # local_time_key. They are added, with the source_file_id index and,
+        # on tables that have their foreign keys already, the local_time_key
+        # one (bulk-day tables get it from build_viewing_constraints).
+        added = self.add_missing_columns(self.Viewing)
+        table_name = self.Viewing.__tablename__
+        inspector  = inspect(self.engine)
+        index_name = viewing_fact_index_name(table_name, VIEWING_FACT_SOURCE_INDEX)
+        indexes = []
+        if index_name not in set(index['name'] for index in inspector.get_indexes(table_name)):
+            indexes.append((index_name, VIEWING_FACT_SOURCE_INDEX))
+        foreign_keys = []
+        if 'local_time_key' in added and inspector.get_foreign_keys(table_name):
+            foreign_keys.append(('local_time_key', self.Time.__tablename__, 'id'))
+        if indexes or foreign_keys:
+            self.storage.add_viewing_constraints(self.session, table_name,
+                                                 indexes, foreign_keys)
+            self.session.commit()
+
     ######### Insertion modules #########
     def raw_insert(self, table_obj, pd_df):
         self.to_thread(self.raw_insert_func, table_obj, pd_df)
 
 
     def raw_insert_func(self, table_obj, pd_df):
-        # use external shell script to do the insertion.
-        def __put_placeholder(pd_df, columns):
-            for col in columns:
-                if col not in pd_df.columns:
-                    pd_df[col] = [None for _ in range(len(pd_df))]
-            return pd_df[columns]
-        table_name = table_obj.__tablename__
-        table_cols = [col.key for col in table_obj.__table__.c]
-        filepath = './vizio_temp/%s_to_insert'%table_name
-        unique_filepath = self.to_csv(__put_placeholder(pd_df, table_cols),
-                                       filepath)
-        os.system(
-            './vizio_data_import_script.sh {file_name} {table_name}'.format(
-                file_name  = unique_filepath,
-                table_name = table_name)
+        self.storage.insert_rows(table_obj, pd_df)
+
+
+    @__db_session
+    def next_viewing_ids(self, rows):
+        # Ids for the next rows of the daily fact table. Only this process
+        # writes the table, so the max id is queried once per date.
+        if self.viewing_max_id is None:
+            self.viewing_max_id = self.session.query(
+                func.max(self.Viewing.id)
+            ).scalar() or 0
+        start_idx = self.viewing_max_id + 1
+        self.viewing_max_id += rows
+        return range(start_idx, start_idx + rows)
+
+
+    def load_viewing(self, pd_df, source_file_id = None):
+        # Fact rows get their ids here, before they are split into shards.
+        # With source_file_id, rows already loaded from that file are replaced.
+        pd_df = pd_df.copy()
+        pd_df['id'] = self.next_viewing_ids(len(pd_df))
+        self.to_thread(self.load_viewing_func, pd_df, source_file_id)
+
+
+    def load_viewing_func(self, pd_df, source_file_id = None):
+        # Large batches are split into fact_shards shards loaded over as many
+        # connections. A failed shard is loaded again; rows of it that made
+        # it in are skipped by their id.
+        table_name = self.Viewing.__tablename__
+        shards = 1
+        if len(pd_df) >= self.fact_shard_min_rows:
+            shards = max(1, self.fact_shards)
+        if shards == 1:
+            # delete and load in one transaction
+            self.load_viewing_shard(table_name, pd_df, source_file_id)
+            return
+
+        if source_file_id is not None:
+            self.delete_viewing_rows(source_file_id)
+        bounds = np.linspace(0, len(pd_df), shards + 1).astype(int)
+        self.run_parallel([
+            (lambda shard = pd_df.iloc[bounds[i]:bounds[i + 1]]:
+                self.load_viewing_shard(table_name, shard))
+            for i in range(shards)
+        ])
+
+
+    def load_viewing_shard(self, table_name, pd_df, source_file_id = None):
+        for attempt in range(1, self.shard_retries + 2):
+            if self.storage.load_viewing_rows(self.Viewing, table_name,
+                                              pd_df, source_file_id):
+                return
+            logger.warning('Loading %s rows to %s failed, attempt %s'%(len(pd_df),
+                                                                     table_name,
+                                                                     attempt))
+        raise IOError('Cannot load %s rows to %s'%(len(pd_df), table_name))
+
+
+    @__db_session
+    def delete_viewing_rows(self, source_file_id):
+        self.session.execute(
+            self.Viewing.__table__.delete().where(
+                self.Viewing.__table__.c.source_file_id == source_file_id
+            )
         )
+        self.session.commit()
+
+
+    def viewing_fingerprints(self, pd_df):
+        # 64 bit hash of the content of fact rows, id and source_file_id aside
+        return key_hashes(pd_df,
+                          self.fingerprint_cols,
+                          datetime_cols = ['viewing_start_time', 'viewing_end_time'])
+
+
+    def is_imported(self, filepath):
+        record = self.fileinfo_registry.get(self.fileinfo_name(filepath))
+        return record is not None and record['imported_date'] is not None
+
+
+    @__db_session
+    def loaded_fingerprints(self, source_file_id):
+        # row_fingerprint of the fact rows of a file, as uint64
+        return np.array([
+            int(row.row_fingerprint) % 2 ** 64
+            for row in self.session.query(self.Viewing.row_fingerprint).filter(
+                self.Viewing.source_file_id == source_file_id,
+                self.Viewing.row_fingerprint != None
+            )
+        ], dtype = np.uint64)
+
+
+    def source_file_id(self, filepath):
+        # vizio_fileinfo id of the file, the row is written first if needed
+        file_name = self.fileinfo_name(filepath)
+        record = self.fileinfo_registry.get(file_name)
+        if record is None or record['id'] is None:
+            self.update_fileinfo(filepath)
+            record = self.fileinfo_registry.get(file_name)
+        return record['id']
+
+
     ######### End of Insertion modules #########
 
+    ######### Session buffer modules #########
+    def session_buffer_path(self):
+        return os.path.join(self.session_dir,
+                            self.current_date.strftime('%Y-%m-%d') + '.pkl')
+
+
+    def load_session_buffer(self):
+        # Buffer saved by hold_sessions for the date, empty if there is none
+        self.session_buffer    = pd.DataFrame()
+        self.session_file_id   = None
+        self.previous_sessions = (None, None)
+        filepath = self.session_buffer_path()
+        if os.path.isfile(filepath):
+            saved = pd.read_pickle(filepath)
+            self.session_buffer    = saved['buffer']
+            self.session_file_id   = saved['file_id']
+            self.previous_sessions = (saved['previous_file_id'], saved['previous_buffer'])
+            logger.info('Loaded %s held over segments from %s'%(len(self.session_buffer),
+                                                               filepath))
+
+
+    def held_sessions(self, source_file_id):
+        # Segments the file source_file_id may continue. When the buffer
+        # was already held after that very file (the run stopped before its
+        # fileinfo was updated), the one held before it is used.
+        if self.session_buffer is None:
+            self.load_session_buffer()
+        if self.session_file_id is not None and self.session_file_id == source_file_id:
+            return self.previous_sessions[1]
+        return self.session_buffer
+
+
+    def hold_sessions(self, held, source_file_id):
+        # Keep held as the buffer after source_file_id, in memory and on disk.
+        # Call once the rows of the file are loaded; the buffer it replaces is
+        # kept too, see held_sessions.
+        if self.session_file_id != source_file_id:
+            self.previous_sessions = (self.session_file_id, self.session_buffer)
+        self.session_buffer  = held if held is not None else pd.DataFrame()
+        self.session_file_id = source_file_id
+        filepath = self.session_buffer_path()
+        if not os.path.isdir(self.session_dir):
+            os.makedirs(self.session_dir)
+        # written aside and renamed, a crash leaves the last one whole
+        pd.to_pickle({'file_id':          self.session_file_id,
+                      'buffer':           self.session_buffer,
+                      'previous_file_id': self.previous_sessions[0],
+                      'previous_buffer':  self.previous_sessions[1]},
+                     filepath + '.tmp')
+        os.rename(filepath + '.tmp', filepath)
+
+
+    def flush_sessions(self):
+        # Insert the segments held over by sessionization and drop the saved
+        # buffer of the date. Waits for the insert.
+        # The rows are tagged with the file they were held after. They are
+        # added to its rows rather than replacing them, so rows a previous
+        # flush already loaded are skipped by their fingerprint.
+        if not self.sessionize:
+            return
+        if self.session_buffer is None:
+            self.load_session_buffer()
+        if len(self.session_buffer):
+            pd_df = self.session_buffer.copy()
+            pd_df['source_file_id'] = self.session_file_id
+            fingerprints = self.viewing_fingerprints(pd_df)
+            pd_df = pd_df.where(pd.notnull(pd_df), None)
+            pd_df['row_fingerprint'] = fingerprints
+            loaded = self.loaded_fingerprints(self.session_file_id)
+            pd_df = pd_df.loc[(pd_df.row_fingerprint.duplicated() == False).values &
+                              ~pd.Series(fingerprints).isin(loaded).values]
+            logger.info('Flushing %s held over segments'%len(pd_df))
+            self.load_viewing(pd_df.filter(self.ViewingCols))
+            self.join_threads()
+        self.session_buffer    = None
+        self.session_file_id   = None
+        self.previous_sessions = (None, None)
+        if os.path.isfile(self.session_buffer_path()):
+            os.remove(self.session_buffer_path())
+    ######### End of Session buffer modules #########
+
     ######### Update activity modules #########
     def raw_update_activity(self, pd_df):
+        if not self.batch_activity_updates:
+            self.to_thread(self.raw_update_activity_func, pd_df)
+            return
+
+        # last_active_date is always the current date, so only ids are kept.
+        ids = pd_df.id.astype(int).values
+        self.pending_activity_ids.update(ids)
+        # Mark them active in memory so later files skip these households.
+        self.activities.set_values(ids, 'last_active_date', self.current_date)
+        if (self.activity_flush_threshold and
+                len(self.pending_activity_ids) >= self.activity_flush_threshold):
+            self.flush_activity_updates()
+
+
+    def flush_activity_updates(self):
+        # One update for every activity id touched since the last flush.
+        # Runs on a thread like the other writes; call join_threads() to wait.
+        if not self.pending_activity_ids:
+            return
+        pd_df = pd.DataFrame(sorted(self.pending_activity_ids), columns = ['id'])
+        pd_df['last_active_date'] = [
+            self.current_date for _ in range(len(pd_df))
+        ]
+        self.pending_activity_ids = set()
         self.to_thread(self.raw_update_activity_func, pd_df)
 
 
     def raw_update_activity_func(self, pd_df):
-        unique_filepath = self.to_csv(pd_df, './vizio_temp/activity_to_update')
-        os.system(
-            './vizio_activity_update_script.sh {file_name}'.format(
-                file_name = unique_filepath)
-        )
+        self.storage.update_activity(self.Activity, pd_df)
     ######### End of Update activity modules #########
 
     ######### Update fileinfo module #########
+    def update_fileinfo(self, filepath, defer = False, **kwargs):
+        # defer=True only stages the change; flush_fileinfo() writes it later
+        # together with the other staged ones.
+        file_name = self.fileinfo_name(filepath)
+        self.fileinfo_registry.stage(file_name, self.current_date, **kwargs)
+        if not defer:
+            self.flush_fileinfo()
+
+
     @__db_session
-    def update_fileinfo(self, filepath, **kwargs):
-        _, file_name = os.path.split(filepath)
-        if file_name in self.fileinfo.file_name.unique():
-            stmt = self.FileInfo.__table__.update(). \
-                    where(self.FileInfo.__table__.c.file_name == file_name). \
-                    values(**kwargs)
-            self.session.execute(stmt)
-        else:
-            new_fileinfo = self.FileInfo(
-                file_name = file_name,
-                data_date = self.current_date,
-                **kwargs
+    def flush_fileinfo(self):
+        # Write every staged fileinfo change in one transaction
+        pending = self.fileinfo_registry.pending
+        if not pending:
+            return
+        table = self.FileInfo.__table__
+
+        new_files = [file_name for file_name in pending
+                     if self.fileinfo_registry.get(file_name)['id'] is None]
+        if new_files:
+            self.session.execute(
+                table.insert(),
+                [dict((col, record[col])
+                      for col in self.fileinfo_registry.columns if col != 'id')
+                 for record in [self.fileinfo_registry.get(file_name)
+                                for file_name in new_files]]
+            )
+
+        # updates with the same set of columns go in one executemany
+        updates = {}
+        for file_name, values in pending.items():
+            if file_name in new_files:
+                continue
+            updates.setdefault(tuple(sorted(values)), []).append(file_name)
+        for cols, file_names in updates.items():
+            stmt = table.update(). \
+                    where(table.c.file_name == bindparam('b_file_name')). \
+                    values(**dict((col, bindparam('b_' + col)) for col in cols))
+            self.session.execute(
+                stmt,
+                [dict([('b_file_name', file_name)] +
+                      [('b_' + col, pending[file_name][col]) for col in cols])
+                 for file_name in file_names]
             )
-            self.session.add(new_fileinfo)
         self.session.commit()
-        self.load_fileinfo(file_name = file_name)
+
+        ids = {}
+        if new_files:
+            for row in self.session.query(self.FileInfo). \
+                    options(load_only('id', 'file_name')). \
+                    filter(self.FileInfo.file_name.in_(new_files)):
+                ids[row.file_name] = row.id
+        self.fileinfo_registry.written(ids)
 
     ######### End of Update fileinfo module #########
 
+    ######### Reach sketch modules #########
+    @__db_session
+    def load_sketches(self):
+        # Sketches of the current date, a re-run keeps adding to them
+        sketches = VizioReachSketches(self.current_date)
+        sketches.load(
+            self.session.query(self.ReachSketch.dimension,
+                               self.ReachSketch.dimension_key,
+                               self.ReachSketch.registers). \
+                filter(self.ReachSketch.sketch_date == self.current_date)
+        )
+        self.sketches = sketches
+
+
+    @__db_session
+    def flush_sketches(self):
+        # Upsert the sketches changed since the last flush, one executemany
+        rows = self.sketches.pending_rows()
+        if not rows:
+            return
+        self.storage.upsert_sketches(self.session, self.ReachSketch, rows)
+        self.session.commit()
+        self.sketches.written()
+
+
+    @__db_session
+    def reach(self, dimension, dimension_keys, start_date, end_date):
+        # Approximate number of households of the dimension keys
+        # ('network', 'program' or 'time') between the dates, inclusive.
+        # Union of the sketches instead of a COUNT(DISTINCT) over fact tables.
+        union = HyperLogLog()
+        query = self.session.query(self.ReachSketch.registers). \
+                    filter(self.ReachSketch.dimension == dimension). \
+                    filter(self.ReachSketch.dimension_key.in_(list(dimension_keys))). \
+                    filter(self.ReachSketch.sketch_date.between(start_date, end_date))
+        for row in query:
+            union.merge(HyperLogLog.from_bytes(row.registers))
+        return union.count()
+    ######### End of Reach sketch modules #########
+
+    ######### Household filter modules #########
+    def load_household_filter(self):
+        # The saved filter, caught up with the households added since it was
+        # saved (ids over its max_id). Built again from self.activities when
+        # there is none, it is full, or the table is behind it.
+        max_id = self.activities.max_id() or 0
+        household_filter, since_id = None, 0
+        if os.path.isfile(self.household_filter_path):
+            household_filter, info = BloomFilter.load(self.household_filter_path)
+            since_id = info.get('max_id', 0)
+            if household_filter.full() or since_id > max_id:
+                logger.info('Rebuilding the household filter')
+                household_filter, since_id = None, 0
+        if household_filter is None:
+            household_filter = BloomFilter.for_capacity(
+                max(self.household_filter_min_capacity, 2 * len(self.activities))
+            )
+        activities = self.activities.frame()
+        household_filter.add(
+            activities.household_id.values[activities.id.values > since_id]
+        )
+        self.household_filter = household_filter
+        self.save_household_filter()
+
+
+    def save_household_filter(self):
+        if self.household_filter is None:
+            return
+        directory = os.path.dirname(self.household_filter_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.household_filter.save(self.household_filter_path,
+                                   max_id = self.activities.max_id() or 0)
+
+
+    def known_households(self, household_ids):
+        # False for households that are surely not in vizio_activity_dim,
+        # True for the ones that may be (all of them without a filter)
+        if self.household_filter is None:
+            return np.ones(len(household_ids), dtype = bool)
+        return self.household_filter.contains(household_ids)
+    ######### End of Household filter modules #########
+
+    ######### Bulk-day modules #########
+    def check_viewing_keys(self, pd_df):
+        # Vectorized key-integrity check against the in-memory dimensions.
+        # Stands in for the per-row foreign key checks of a bare fact table.
+        # Returns a boolean Series marking rows with a broken key.
+        checks = [
+            ('demographic_key', 'demographics', False),
+            ('location_key',    'locations',    True),
+            ('network_key',     'networks',     True),
+            ('program_key',     'programs',     True),
+            ('time_key',        'times',        False),
+            ('local_time_key',  'times',        True)
+        ]
+        broken = pd.Series(False, index = pd_df.index)
+        for col, name, nullable in checks:
+            # keys are objects with None once the rows are ready to load
+            keys    = pd.to_numeric(pd_df[col], errors = 'coerce')
+            missing = keys.isnull()
+            broken |= (missing == False) & (
+                getattr(self, name).contains(keys.values) == False
+            )
+            if not nullable:
+                broken |= missing
+        return broken
+
+
+    @__db_session
+    def build_viewing_constraints(self):
+        # Build the indexes and foreign keys of the daily fact table, in one
+        # ALTER TABLE on MySQL. Ones that already exist are skipped.
+        table_name = self.Viewing.__tablename__
+        inspector  = inspect(self.engine)
+        existing_indexes = set(
+            index['name'] for index in inspector.get_indexes(table_name)
+        )
+        existing_fks = set(
+            tuple(fk['constrained_columns'])
+            for fk in inspector.get_foreign_keys(table_name)
+        )
+
+        indexes = []
+        for column in VIEWING_FACT_INDEXES:
+            index_name = viewing_fact_index_name(table_name, column)
+            if index_name not in existing_indexes:
+                indexes.append((index_name, column))
+        foreign_keys = []
+        for columns, refcolumns in viewing_fact_foreign_keys(self.year, self.month):
+            if tuple(columns) in existing_fks:
+                continue
+            ref_table, ref_column = refcolumns[0].split('.')
+            foreign_keys.append((columns[0], ref_table, ref_column))
+        if not indexes and not foreign_keys:
+            return
+
+        self.storage.add_viewing_constraints(self.session, table_name,
+                                             indexes, foreign_keys)
+        self.session.commit()
+    ######### End of Bulk-day modules #########
+
+    ######### Memory budget modules #########
+    def enforce_memory_budget(self):
+        # While over budget, spill the largest in-memory dimension to disk.
+        # Once all are spilled, their appended rows are moved to disk too.
+        # Returns the memory report for the logs.
+        while self.memory_budget.exceeded():
+            in_memory = [
+                (getattr(self, name).memory_usage(), name)
+                for name in self.spillable_dimensions
+                if isinstance(getattr(self, name), VizioDimension)
+            ]
+            if not in_memory:
+                for name in self.spillable_dimensions:
+                    getattr(self, name).compact()
+                gc.collect()
+                break
+            _, name = max(in_memory)
+            self.spill_dimension(name)
+        return self.memory_budget.report()
+
+
+    def spill_dimension(self, name):
+        # Move a spillable dimension to memory-mapped files, see MmapDimension
+        columns, datetime_cols = self.spillable_dimensions[name]
+        setattr(self, name, MmapDimension(getattr(self, name).frame(),
+                                          self.dimension_keys[name],
+                                          columns,
+                                          self.spill_dir,
+                                          name = name,
+                                          datetime_cols = datetime_cols))
+        gc.collect()
+    ######### End of Memory budget modules #########
+
+    ######### Time dimension modules #########
+    def prepopulate_times(self, years):
+        # Insert every (date, time_slot) of the years missing in
+        # vizio_time_dim, then rebuild the time_key lookup.
+        dates = []
+        for year in years:
+            day = date(year, 1, 1)
+            while day.year == year:
+                dates.append(day)
+                day += timedelta(days = 1)
+        self.insert_times(dates)
+        self.build_time_index()
+
+
+    def insert_times(self, dates):
+        # Insert every (date, time_slot) of the dates missing in vizio_time_dim
+        slots = 48
+        all_times = pd.DataFrame({
+            'time_slot':   np.tile(np.arange(1, slots + 1), len(dates)),
+            'date':        np.repeat(dates, slots),
+            'day_of_week': np.repeat([x.isoweekday() for x in dates], slots),
+            'week':        np.repeat([x.isocalendar()[1] for x in dates], slots),
+            'quarter':     np.repeat([int(math.ceil(x.month/3.0)) for x in dates], slots)
+        })
+        temp = self.times.lookup(all_times).id.isnull()
+        all_times = all_times.loc[temp.values].reset_index(drop = True)
+
+        if len(all_times) > 0:
+            start_idx = (self.times.max_id() or 0) + 1
+            all_times['id'] = range(start_idx, start_idx + len(all_times))
+            self.raw_insert(self.Time, all_times.filter(self.TimeCols))
+            self.join_threads()
+            self.times.append(all_times[['id',
+                                         'time_slot',
+                                         'date']])
+
+
+    def build_time_index(self):
+        # time_index[(date - time_index_base).days * 48 + time_slot - 1] = time_key
+        dates   = pd.to_datetime(pd.Series(self.times.column('date')))
+        self.time_index_base = dates.min()
+        offsets = ((dates - self.time_index_base).dt.days.values * 48
+                   + self.times.column('time_slot').astype(int) - 1)
+        time_index = np.zeros(offsets.max() + 1, dtype = np.int64)
+        time_index[offsets] = self.times.column('id')
+        self.time_index = time_index
+
+
+    def lookup_time_keys(self, dates, time_slots):
+        # Vectorized time_key of (date, time_slot) pairs. Years that are not
+        # materialized yet are filled on the way; pairs still unknown after
+        # that (bad slots) get NaN.
+        dates   = pd.to_datetime(pd.Series(np.asarray(dates)))
+        slots   = np.asarray(time_slots, dtype = np.int64)
+        keys    = self.time_index_lookup(dates, slots)
+        if (keys == 0).sum():
+            self.prepopulate_times(sorted(set(dates[keys == 0].dt.year)))
+            keys = self.time_index_lookup(dates, slots)
+        if (keys == 0).sum():
+            keys = np.where(keys == 0, np.nan, keys)
+        return keys
+
+
+    def time_index_lookup(self, dates, slots):
+        offsets = ((dates - self.time_index_base).dt.days.values * 48 + slots - 1)
+        valid   = ((slots >= 1) & (slots <= 48) &
+                   (offsets >= 0) & (offsets < len(self.time_index)))
+        keys    = np.zeros(len(offsets), dtype = np.int64)
+        keys[valid] = self.time_index[offsets[valid]]
+        return keys
+    ######### End of Time dimension modules #########
+
     ######### Utilities #########
     def to_thread(self, target, *args):
-        t = threading.Thread(
-                target = target,
-                args = args
-            )
+        # Exceptions of target are kept and raised again by join_threads
+        def run():
+            try:
+                target(*args)
+            except Exception:
+                logger.exception('%s failed'%target.__name__)
+                self.thread_errors.append(sys.exc_info())
+        t = threading.Thread(target = run)
         t.start()
         self.threads.append(t)
 
 
+    def run_parallel(self, targets):
+        # Run each target on its own thread and wait for all of them.
+        # The first exception raised by a target is raised again here.
+        errors  = []
+        def run(target):
+            try:
+                target()
+            except Exception:
+                errors.append(sys.exc_info())
+        threads = [threading.Thread(target = run, args = (target, ))
+                   for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+
+    def join_threads(self):
+        # Waits for the threads of to_thread. The first exception one of them
+        # raised is raised again here, so nothing after (fileinfo updates)
+        # goes on as if the writes had made it.
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.thread_errors:
+            exc_type, exc_value, exc_traceback = self.thread_errors[0]
+            self.thread_errors = []
+            raise exc_type, exc_value, exc_traceback
+
+
     def get_datetime(self, datetime_str):
         # datetime_str = '%Y-%m-%d %H-%M-%S'
         if self.datetimes.get(datetime_str) is None:
@@ -369,15 +1210,12 @@ class VizioDBConnection(object):
         return self.datetimes[datetime_str]
 
 
-    def to_csv(self, pd_df, filepath):
-        # save locally to be used by shell script to run file upload to database.
-        unique_filepath = filepath + '_' + uuid4().hex
-        pd_df.to_csv(unique_filepath,
-                     index = False,
-                     header = False,
-                     sep = '^',
-                     na_rep = '\N')
-        return unique_filepath
+    def fileinfo_name(self, filepath):
+        # Parts are kept gzipped; fileinfo names them without .gz
+        _, file_name = os.path.split(filepath)
+        if file_name.endswith('.gz'):
+            file_name = file_name[:-3]
+        return file_name
 
 
     def clean_up_temp(self):
@@ -0,0 +1,211 @@
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+
+def key_hashes(frame, on, datetime_cols = (), categorize = True):
+    # 64 bit hash of the natural key columns of each row. Nulls hash alike
+    # whether they are None or NaN; datetime_cols hash alike whether they
+    # hold datetime64 or objects. categorize only pays off with repeated
+    # keys, the hashes are the same either way.
+    keys = {}
+    for col in on:
+        values = frame[col]
+        if col in datetime_cols:
+            values = pd.to_datetime(values)
+        elif values.dtype == object:
+            values = values.where(values.notnull(), '')
+        keys[col] = values
+    keys = pd.DataFrame(keys, columns = on)
+    return pd.util.hash_pandas_object(keys, index = False,
+                                      categorize = categorize).values.astype(np.uint64)
+
+
+class VizioDimension(object):
+    # Append-only columnar dimension table.
+    # 1. Initiate class by VizioDimension(frame, on), on being the natural key
+    # 2. append() new rows; lookup() ids of rows by natural key
+    #
+    # Each column is a numpy array with spare capacity, doubled when full,
+    # so appending only copies the new rows. column() and frame() are views
+    # of the filled part. frame() is built once per change and cached.
+    # rows maps the key_hashes of the natural key to the row holding it (the
+    # last one), updated by append, so lookup only hashes the frame it is
+    # given and takes the rows from the arrays.
+    #
+    # Lookup API, shared with MmapDimension:
+    #   lookup(frame, columns)  - id and columns of the rows of frame, NaN if missing
+    #   contains(ids)           - boolean array, ids present in the dimension
+    #   append(rows)            - add rows (natural key, id and columns)
+    #   set_values(ids, column, value)
+    #   column(col), take(mask), max_id(), len()
+
+    def __init__(self, frame, on, capacity = 1024):
+        self.on      = on
+        self.columns = list(frame.columns)
+        self.size    = 0
+        self.data    = OrderedDict()
+        capacity     = max(capacity, len(frame))
+        for col in self.columns:
+            dtype = frame[col].dtype
+            if not isinstance(dtype, np.dtype):
+                # categoricals and other extension types are kept as objects
+                dtype = np.dtype(object)
+            self.data[col] = np.empty(capacity, dtype = dtype)
+        self.max_id_  = None
+        self.frame_   = None
+        self.rows     = {}
+        self.datetime_cols = [col for col in on
+                              if np.issubdtype(self.data[col].dtype, np.datetime64)]
+        self.append(frame)
+
+
+    def reserve(self, size):
+        # grow every column to hold size rows, doubling the capacity
+        capacity = len(self.data[self.columns[0]])
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for col in self.columns:
+            grown = np.empty(capacity, dtype = self.data[col].dtype)
+            grown[:self.size] = self.data[col][:self.size]
+            self.data[col] = grown
+
+
+    def to_values(self, col, values):
+        if np.issubdtype(self.data[col].dtype, np.datetime64):
+            return pd.to_datetime(values).values
+        return np.asarray(values)
+
+
+    def append(self, rows):
+        n = len(rows)
+        if n == 0:
+            return
+        self.reserve(self.size + n)
+        for col in self.columns:
+            self.data[col][self.size:self.size + n] = self.to_values(col, rows[col])
+        self.index_rows(self.size, self.size + n)
+        self.size += n
+        if 'id' in rows:
+            max_id = int(np.max(rows['id'].values))
+            if self.max_id_ is None or max_id > self.max_id_:
+                self.max_id_ = max_id
+        self.frame_ = None
+
+
+    def column(self, col):
+        # zero-copy view of the filled part of a column
+        return self.data[col][:self.size]
+
+
+    def frame(self):
+        if self.frame_ is None:
+            self.frame_ = pd.DataFrame(
+                OrderedDict((col, self.column(col)) for col in self.columns),
+                columns = self.columns
+            )
+        return self.frame_
+
+
+    def key_frame(self, frame):
+        # Natural key columns of frame in the dtypes they are stored in, so
+        # they hash alike. Rows whose numeric key does not fit the stored
+        # dtype (nulls, fractions) cannot match, they are False in valid.
+        keys  = {}
+        valid = np.ones(len(frame), dtype = bool)
+        for col in self.on:
+            dtype  = self.data[col].dtype
+            values = frame[col]
+            if dtype.kind in 'iufb' and values.dtype != dtype:
+                numeric = pd.to_numeric(values, errors = 'coerce')
+                fits    = numeric.notnull().values
+                if dtype.kind != 'f':
+                    fits = fits & (numeric.fillna(0) % 1 == 0).values
+                valid  &= fits
+                values  = numeric.where(fits, 0).astype(dtype)
+            elif dtype.kind not in 'iufbM' and values.dtype != object:
+                values = values.astype(object)
+            keys[col] = values.values
+        return pd.DataFrame(keys, columns = self.on), valid
+
+
+    def index_rows(self, start, end):
+        # add rows start:end to self.rows, later rows win
+        keys = pd.DataFrame(
+            OrderedDict((col, self.data[col][start:end]) for col in self.on),
+            columns = self.on
+        )
+        # dimension keys are unique
+        hashes = key_hashes(keys, self.on, self.datetime_cols, categorize = False)
+        self.rows.update(zip(hashes.tolist(), range(start, end)))
+
+
+    def reindex(self):
+        self.rows = {}
+        self.index_rows(0, self.size)
+
+
+    def lookup(self, frame, columns = ()):
+        # DataFrame of id and columns aligned with frame
+        columns = list(columns)
+        keys, valid = self.key_frame(frame)
+        hashes = key_hashes(keys, self.on, self.datetime_cols)
+        get    = self.rows.get
+        rows   = np.array([get(h, -1) for h in hashes.tolist()], dtype = np.int64)
+        rows[valid == False] = -1
+        found  = rows >= 0
+        rows   = np.where(found, rows, 0)
+        result = OrderedDict()
+        for col in ['id'] + columns:
+            values = self.column(col)[rows] if self.size else np.empty(len(rows), dtype = object)
+            if not found.all():
+                values = pd.Series(values).where(found).values
+            result[col] = values
+        return pd.DataFrame(result, index = frame.index, columns = ['id'] + columns)
+
+
+    def contains(self, ids):
+        # ids may come as objects with None (rows after where(notnull, None)),
+        # both sides are compared as float64
+        ids = pd.to_numeric(pd.Series(np.asarray(ids, dtype = object)), errors = 'coerce')
+        return ids.astype(np.float64).isin(
+            self.column('id').astype(np.float64)
+        ).values
+
+
+    def set_values(self, ids, column, value):
+        mask = pd.Series(self.column('id')).isin(ids).values
+        self.data[column][:self.size][mask] = value
+        self.frame_ = None
+        if column in self.on:
+            self.reindex()
+
+
+    def take(self, mask):
+        # keep the rows where mask is True, in place
+        mask = np.asarray(mask, dtype = bool)
+        kept = int(mask.sum())
+        for col in self.columns:
+            self.data[col][:kept] = self.data[col][:self.size][mask]
+        self.size = kept
+        self.frame_ = None
+        self.reindex()
+
+
+    def memory_usage(self):
+        # rough size of the key index: a dict entry and two integers per key
+        index_bytes = len(self.rows) * 100
+        return index_bytes + sum(
+            pd.Series(self.column(col)).memory_usage(index = False, deep = True)
+            for col in self.columns
+        )
+
+
+    def max_id(self):
+        return self.max_id_
+
+
+    def __len__(self):
+        return self.size
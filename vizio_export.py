@@ -0,0 +1,187 @@
+import gzip
+import sys
+import pandas as pd
+from datetime import datetime, date
+from sqlalchemy import select, inspect, types
+from vizio_db_connection import VizioDBConnection
+from local_logger import LocalLogger
+
+logger = LocalLogger(
+            logger_name = __name__,
+            logfile = 'vizio_export_{0}.log'.format(
+                datetime.today().strftime(LocalLogger.date_suffix_fmt)
+            )
+        ).logger
+
+def arrow_type(pyarrow, column_type):
+    # pyarrow type of the values of a SQLAlchemy column
+    column_type = getattr(column_type, 'impl', column_type) # variants
+    if isinstance(column_type, types.Integer):
+        if getattr(column_type, 'unsigned', False):
+            return pyarrow.uint64()
+        return pyarrow.int64()
+    if isinstance(column_type, types.Float):
+        return pyarrow.float64()
+    if isinstance(column_type, types.DateTime):
+        return pyarrow.timestamp('us')
+    if isinstance(column_type, types.Date):
+        return pyarrow.date32()
+    if isinstance(column_type, types.LargeBinary):
+        return pyarrow.binary()
+    if isinstance(column_type, types.String):
+        return pyarrow.string()
+    raise ValueError('No parquet type for %s'%column_type)
+
+
+class VizioDayExporter(VizioDBConnection):
+    # Flat extract of one daily fact table joined with its dimensions.
+    # 1. Initiate class by VizioDayExporter(year, month, day)
+    # 2. export_day(output_path, file_format = 'csv' or 'parquet')
+    #
+    # Fact rows are streamed through a server-side cursor batch_size rows at
+    # a time and joined in memory against the dimension frames, so memory
+    # stays the same whatever the size of the day.
+    #
+    # Tables are not created; the fact table of the day has to exist.
+
+    # fact key -> dimension table attribute
+    export_dimensions = [
+        ('demographic_key', 'Demographic'),
+        ('location_key',    'Location'),
+        ('network_key',     'Network'),
+        ('program_key',     'Program'),
+        ('time_key',        'Time')
+    ]
+
+    # fact columns kept in the extract
+    export_fact_cols = ['program_time_at_start',
+                        'viewing_start_time',
+                        'viewing_end_time',
+                        'viewing_duration']
+
+    def __init__(self, year, month, day, **kwargs):
+        kwargs['load_references'] = False
+        kwargs['create_tables']   = False
+        super(VizioDayExporter, self).__init__(year, month, day, **kwargs)
+        table_name = self.Viewing.__tablename__
+        if table_name not in inspect(self.engine).get_table_names():
+            logger.error('%s does not exist'%table_name)
+            raise ValueError('Nothing to export, %s does not exist'%table_name)
+        self.export_frames = {}
+        for _, table_attr in self.export_dimensions:
+            self.export_frames[table_attr] = self.load_dimension_frame(
+                getattr(self, table_attr)
+            )
+
+
+    def load_dimension_frame(self, table_obj):
+        # Every column of the dimension table, indexed by id
+        columns = [col.key for col in table_obj.__table__.c]
+        connection = self.engine.connect()
+        try:
+            rows = connection.execute(select([table_obj.__table__])).fetchall()
+        finally:
+            connection.close()
+        frame = pd.DataFrame([list(row) for row in rows], columns = columns)
+        return frame.set_index('id')
+
+
+    def export_columns(self):
+        # (name, table column) of the extract, in the order of denormalize
+        columns = []
+        for _, table_attr in self.export_dimensions:
+            columns += [(col.key, col)
+                        for col in getattr(self, table_attr).__table__.c
+                        if col.key != 'id']
+        fact_cols = self.Viewing.__table__.c
+        columns += [(col, fact_cols[col]) for col in self.export_fact_cols]
+        return columns
+
+
+    def export_schema(self, pyarrow):
+        # parquet schema from the column types of the tables, so it does not
+        # depend on what the first batch happens to hold (all-null columns)
+        return pyarrow.schema([
+            pyarrow.field(name, arrow_type(pyarrow, col.type), nullable = True)
+            for name, col in self.export_columns()
+        ])
+
+
+    def denormalize(self, facts):
+        # Dimension columns of each fact row, by key
+        parts = []
+        for key, table_attr in self.export_dimensions:
+            frame  = self.export_frames[table_attr]
+            joined = frame.reindex(facts[key].values)
+            joined.index = facts.index
+            parts.append(joined)
+        parts.append(facts[self.export_fact_cols])
+        return pd.concat(parts, axis = 1)
+
+
+    def stream_day(self, batch_size = 100000):
+        # Denormalized fact rows of the day, batch_size rows at a time
+        connection = self.engine.connect().execution_options(stream_results = True)
+        try:
+            result  = connection.execute(select([self.Viewing.__table__]))
+            columns = list(result.keys())
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                facts = pd.DataFrame([list(row) for row in rows], columns = columns)
+                yield self.denormalize(facts)
+        finally:
+            connection.close()
+
+
+    def export_day(self, output_path, file_format = 'csv', batch_size = 100000):
+        # csv is written gzip compressed, parquet with snappy
+        logger.info('Exporting %s to %s'%(self.Viewing.__tablename__, output_path))
+        rows = 0
+        if file_format == 'csv':
+            with gzip.open(output_path, 'wb') as f:
+                for batch in self.stream_day(batch_size):
+                    batch.to_csv(f, header = rows == 0, index = False)
+                    rows += len(batch)
+        elif file_format == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet as pq
+            except ImportError:
+                logger.error('pyarrow is needed for parquet exports')
+                raise
+            schema = self.export_schema(pyarrow)
+            writer = pq.ParquetWriter(output_path, schema, compression = 'snappy')
+            try:
+                for batch in self.stream_day(batch_size):
+                    writer.write_table(pyarrow.Table.from_pandas(batch,
+                                                                 schema = schema,
+                                                                 preserve_index = False))
+                    rows += len(batch)
+            finally:
+                writer.close()
+        else:
+            raise ValueError('Unknown export format %s'%file_format)
+        logger.info('Exported %s rows of %s'%(rows, self.Viewing.__tablename__))
+        return rows
+
+
+if __name__ == '__main__':
+    args = {}
+    for arg in sys.argv[1:]:
+        k, v = arg.split('=', 1)
+        args[k.strip()] = v.strip()
+    date_str = args.get('date')
+    output_path = args.get('output')
+
+    if date_str is None or output_path is None:
+        print 'date and output arguments are required'
+        sys.exit(1)
+    year, month, day = [int(x) for x in date_str.split('-')]
+    exporter = VizioDayExporter(year, month, day)
+    exporter.export_day(output_path,
+                        file_format = args.get('format', 'csv'),
+                        batch_size = int(args.get('batch_size', 100000)))
+
+#python vizio_export.py date=2017-05-17 output=./vizio_2017-05-17.csv.gz format=csv
@@ -1,10 +1,10 @@
 from config import Config
 import os
-import re
 from datetime import datetime, date
 from Queue import Queue
 from boto.s3.connection import S3Connection
 from local_logger import LocalLogger
+from vizio_s3_index import VizioS3Index
 
 logger = LocalLogger(
             logger_name = __name__,
@@ -16,12 +16,13 @@ logger = LocalLogger(
 
 class VizioFileDownloader(object):
 
-    def __init__(self, DBconnection,  year, month, day):
+    def __init__(self, DBconnection,  year, month, day, index_dir = None):
         # Connection need to be VizioDBConnection
         logger.info('Initializing...')
         self.db_conn = DBconnection
-        self.date_str = date(year, month, day).strftime('%Y-%m-%d')
-
+        if index_dir is None:
+            index_dir = '/files2/Vizio/data/s3_download/s3_index'
+        self.index_dir = index_dir
 
         self.config  = Config()
         access_key = self.config.S3_CONNECTIONS['vizio']['access_key']
@@ -29,48 +30,54 @@ class VizioFileDownloader(object):
         bucket_name = self.config.S3_CONNECTIONS['vizio']['bucket']
         self.s3_conn = S3Connection(access_key, secret_key)
         self.bucket = self.s3_conn.get_bucket(bucket_name)
+        self.downloaded = Queue()
 
-        filenames     = []
-        files_by_date = {}
-        no_date_files = []
-        for key in self.bucket.list(prefix='vizio/content/content/%s/'%self.date_str):
-            name = key.name
-            filenames.append(name)
-            match = re.search("([0-9]{4}\-[0-9]{2}\-[0-9]{2})", name)
-            if match:
-                date_str = name[match.start():match.end()]
-                if files_by_date.get(date_str):
-                    files_by_date[date_str].append(key)
-                else:
-                    files_by_date[date_str] = [key]
-            else:
-                no_date_files.append(name)
+        self.set_date(year, month, day)
+        logger.info('Initialization Complete')
+
+    def set_date(self, year, month, day):
+        # Start watching a new date prefix. Its listing index is kept on disk,
+        # so only keys after the last seen one are listed again.
+        self.year, self.month, self.day = year, month, day
+        self.date_str = date(year, month, day).strftime('%Y-%m-%d')
+        self.prefix   = 'vizio/content/content/%s/'%self.date_str
+        self.index    = VizioS3Index(
+            self.bucket,
+            self.prefix,
+            os.path.join(self.index_dir, '%s.json'%self.date_str)
+        )
+        self.poll()
 
-        self.filenames     = filenames
-        self.files_by_date = files_by_date
-        self.no_date_files = no_date_files
-        self.downloaded    = Queue()
         self.files_available = True
-        if (self.files_by_date.get(self.date_str) is None
-                or len(self.files_by_date.get(self.date_str)) == 0):
+        if len(self.date_keys()) == 0:
             logger.info('No files to donwload for date %s'%self.date_str)
             print 'No files to donwload for date %s'%self.date_str
             self.files_available = False
-        logger.info('Initialization Complete')
+
+    def poll(self):
+        # Refresh the listing index. Returns the new or changed keys.
+        changed = self.index.refresh()
+        self.filenames = sorted(self.index.keys)
+        if changed:
+            self.files_available = True
+        return changed
+
+    def date_keys(self):
+        # keys of the date, manifests included
+        return [name for name in self.filenames if name.find(self.date_str) != -1]
 
     def refresh(self):
-        self.__init__(self.db_conn)
+        self.poll()
 
-    def download(self, path = None, unzip = True, refresh = False, overwrite = False):
+    def download(self, path = None, unzip = False, refresh = False, overwrite = False):
         # date_str has to be in YYYY-MM-DD
-        # For now, download everything again even if there's something.
+        # Downloads new keys and keys re-delivered with a new etag.
+        # Parts stay gzipped unless unzip is True; the importer reads them as is.
 
         if refresh is True:
             self.refresh()
 
         self.db_conn.load_fileinfo()
-        current_files = self.db_conn.fileinfo
-        current_file_names = set(current_files.file_name.unique())
 
         if path is None:
             path = '/files2/Vizio/data/s3_download/vizio_unzipped'
@@ -85,27 +92,58 @@ class VizioFileDownloader(object):
         if not self.files_available:
             return self.file_path
 
-        for key in self.files_by_date[self.date_str]:
-            print 'Downloading file: ', key.name
-            _, file_name = os.path.split(key.name)
+        if overwrite:
+            names = self.date_keys()
+        else:
+            changed = set(self.index.changed_keys())
+            names = [name for name in self.date_keys() if name in changed]
+
+        # fileinfo of the downloads is written in one transaction at the end,
+        # then the index marks them downloaded
+        downloaded = []
+        for name in names:
+            _, file_name = os.path.split(name)
             dest_file_path = os.path.join(file_path, file_name)
+            # the name the importer gives the part in fileinfo
+            fileinfo_name = self.db_conn.fileinfo_name(file_name)
+            redelivery = self.index.is_redelivery(name)
+            if (not overwrite and not redelivery
+                    and (os.path.isfile(dest_file_path) or
+                         os.path.isfile(dest_file_path[:-3]))):
+                # downloaded before the index existed
+                if fileinfo_name not in self.db_conn.fileinfo_registry:
+                    self.db_conn.update_fileinfo(fileinfo_name,
+                                                 defer = True,
+                                                 downloaded_date = datetime.now())
+                downloaded.append(name)
+                continue
+            print 'Downloading file: ', name
             logger.info(
                 'Dowloading file {file_name} to {file_path}'.format(
                     file_name = file_name,
                     file_path = file_path
                 )
             )
-            if not overwrite and os.path.isfile(dest_file_path[:-3]):
-                continue
             try:
                 os.remove(dest_file_path[:-3])
                 os.remove(dest_file_path)
             except Exception as e:
                 pass
                 # When files don't exist
-            key.get_contents_to_filename(dest_file_path)
-            self.db_conn.update_fileinfo(os.path.splitext(file_name)[0],
-                                         downloaded_date = datetime.now())
+            self.bucket.new_key(name).get_contents_to_filename(dest_file_path)
+            if redelivery:
+                # Same name, new content. Import it again.
+                logger.info('Re-delivered file %s'%file_name)
+                self.db_conn.update_fileinfo(fileinfo_name,
+                                             defer = True,
+                                             downloaded_date = datetime.now(),
+                                             revised_date = datetime.now(),
+                                             imported_date = None)
+            else:
+                self.db_conn.update_fileinfo(fileinfo_name,
+                                             defer = True,
+                                             downloaded_date = datetime.now())
+            downloaded.append(name)
 
             if unzip is True:
                 try:
@@ -114,4 +152,6 @@ class VizioFileDownloader(object):
                     pass
                     # When the file is not a zip file.
 
+        self.db_conn.flush_fileinfo()
+        self.index.mark_downloaded(downloaded)
         return file_path
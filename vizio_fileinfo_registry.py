@@ -0,0 +1,92 @@
+import pandas as pd
+
+
+class VizioFileInfoRegistry(object):
+    # In-memory copy of vizio_fileinfo, indexed by file name and by data date.
+    # 1. load() rows queried from the table
+    # 2. stage() status changes; they are kept as pending writes
+    # 3. VizioDBConnection.flush_fileinfo() writes the pending ones in one
+    #    transaction and calls written()
+
+    columns = ['id',
+               'file_name',
+               'data_date',
+               'downloaded_date',
+               'imported_date',
+               'revised_date',
+               'sample_rate']
+
+    def __init__(self):
+        self.records = {} # file_name -> row as dict
+        self.by_date = {} # data_date -> set of file_names
+        self.pending = {} # file_name -> columns changed since last flush
+
+
+    def load(self, rows):
+        # rows are lists in the order of columns. Rows with staged changes
+        # keep the in-memory version.
+        for row in rows:
+            record = dict(zip(self.columns, row))
+            if record['file_name'] in self.pending:
+                continue
+            self.records[record['file_name']] = record
+            self.by_date.setdefault(record['data_date'], set()).add(record['file_name'])
+
+
+    def get(self, file_name):
+        return self.records.get(file_name)
+
+
+    def __contains__(self, file_name):
+        return file_name in self.records
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def stage(self, file_name, data_date, **kwargs):
+        # New files get data_date; existing ones keep theirs
+        record = self.records.get(file_name)
+        if record is None:
+            record = dict((col, None) for col in self.columns)
+            record['file_name'] = file_name
+            record['data_date'] = data_date
+            self.records[file_name] = record
+            self.by_date.setdefault(data_date, set()).add(file_name)
+        record.update(kwargs)
+        self.pending.setdefault(file_name, {}).update(kwargs)
+
+
+    def written(self, ids = None):
+        # Pending writes are in the table now. ids maps file_name to the id
+        # of rows that were inserted.
+        for file_name, id_ in (ids or {}).items():
+            self.records[file_name]['id'] = id_
+        self.pending = {}
+
+
+    def files_for_date(self, data_date):
+        return sorted(self.by_date.get(data_date, ()))
+
+
+    def pending_files(self, data_date):
+        # Parts of the date that are not imported yet. Manifests get fileinfo
+        # rows when they are downloaded but are never imported.
+        return [file_name for file_name in self.files_for_date(data_date)
+                if self.records[file_name]['imported_date'] is None and
+                file_name.find('_manifest') == -1]
+
+
+    def imported_sample_rates(self, data_date, exclude = None):
+        # Sample rates the imported files of the date were loaded with
+        return set(self.records[file_name]['sample_rate']
+                   for file_name in self.files_for_date(data_date)
+                   if file_name != exclude and
+                   self.records[file_name]['imported_date'] is not None)
+
+
+    def to_frame(self):
+        return pd.DataFrame([[record[col] for col in self.columns]
+                             for record in self.records.values()],
+                            columns = self.columns)
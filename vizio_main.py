@@ -1,6 +1,7 @@
 import os
 import sys
-from datetime import datetime, date
+from time import sleep
+from datetime import datetime, date, timedelta
 from local_logger import LocalLogger
 from vizio_data_import import VizioImporter
 from vizio_file_download import VizioFileDownloader
@@ -12,24 +13,107 @@ logger = LocalLogger(
             )
         ).logger
 
-def main(year, month, day, file_path):
+def import_pending(importer, folder_path, failures = None, max_failures = 3):
+    # Import every downloaded part of the date that is not imported yet
+    # Parts may be gzipped on disk, fileinfo names them without .gz
+    # With a failures dict (file name -> failed imports), a failing part is
+    # logged and counted instead of stopping the others, and skipped once it
+    # failed max_failures times.
+    registry = importer.fileinfo_registry
+    local_files = dict((importer.fileinfo_name(file_name), file_name)
+                       for file_name in os.listdir(folder_path))
+    for file_name in sorted(local_files):
+        if file_name.find('_manifest') == -1 and file_name not in registry:
+            logger.warning('Table and local directory out of sync. Check %s'%local_files[file_name])
+    filepaths = [os.path.join(folder_path, local_files[file_name])
+                 for file_name in registry.pending_files(importer.current_date)
+                 if file_name in local_files and file_name.find('_manifest') == -1]
+    if importer.day_batch:
+        importer.import_day(filepaths, failures, max_failures)
+        return
+    for filepath in filepaths:
+        if failures is None:
+            importer.import_file(filepath)
+            continue
+        if importer.failed_too_often(filepath, failures, max_failures):
+            continue
+        try:
+            importer.import_file(filepath)
+        except Exception:
+            importer.count_failure(filepath, failures, max_failures)
+
+def finish_day(importer):
+    # End-of-day work of the batched modes
+    if importer.sessionize:
+        logger.info('Flushing held over sessions')
+        importer.flush_sessions()
+        importer.join_threads()
+        importer.clean_up_temp()
+    if importer.batch_activity_updates:
+        logger.info('Flushing %s batched activity updates'%len(importer.pending_activity_ids))
+        importer.flush_activity_updates()
+        importer.join_threads()
+        importer.clean_up_temp()
+    if importer.bulk_day:
+        logger.info('Building indexes and foreign keys of %s'%importer.Viewing.__tablename__)
+        importer.build_viewing_constraints()
+
+def main(year, month, day, file_path, **importer_options):
     date_str = date(year, month, day).strftime('%Y-%m-%d')
     logger.info('Running the script for %s'%date_str)
-    importer = VizioImporter(year, month, day)
+    importer = VizioImporter(year, month, day, **importer_options)
     downloader = VizioFileDownloader(importer, year, month, day)
     folder_path = downloader.download(path = file_path)
-    files = []
-    for file_name in os.listdir(folder_path):
-        if file_name.find('_manifest') == -1:
-            files.append(file_name)
-    files.sort()
-    for file_name in files:
-        current_fileinfo = importer.fileinfo.loc[importer.fileinfo.file_name == file_name]
-        if len(current_fileinfo) == 0:
-            logger.warning('Table and local directory out of sync. Check %s'%file_name)
-            continue
-        if current_fileinfo['imported_date'].isnull().sum() > 0:
-            importer.import_file(os.path.join(folder_path, file_name))
+    import_pending(importer, folder_path)
+    finish_day(importer)
+
+def watch(file_path, poll_interval = 300, grace_period = 3600, max_failures = 3,
+          max_backoff = 3600, **importer_options):
+    # Daemon mode. Keeps one warm importer and polls the S3 prefix of the
+    # current date, importing new parts as they land. Parts of a day keep
+    # arriving after midnight, so the day is only rolled over grace_period
+    # seconds after it ends (after one last poll).
+    # A failing poll is logged and tried again after twice the previous
+    # delay, up to max_backoff seconds; pending parts are retried on every
+    # poll, until one failed max_failures times (see import_pending).
+    today = date.today()
+    logger.info('Watching for new files from %s'%today.strftime('%Y-%m-%d'))
+    importer = downloader = folder_path = None
+    failures = {}
+    stale = True # the local folder may be behind S3
+    delay = 0
+    while True:
+        sleep(delay)
+        try:
+            if importer is None:
+                importer = VizioImporter(today.year, today.month, today.day,
+                                         **importer_options)
+            if downloader is None:
+                downloader = VizioFileDownloader(importer, today.year, today.month,
+                                                 today.day)
+            if downloader.poll():
+                stale = True
+            if stale:
+                folder_path = downloader.download(path = file_path)
+                stale = False
+            import_pending(importer, folder_path, failures, max_failures)
+
+            day_end = datetime.combine(importer.current_date + timedelta(days = 1),
+                                       datetime.min.time())
+            if datetime.now() >= day_end + timedelta(seconds = grace_period):
+                # Roll over to the next day
+                finish_day(importer)
+                next_date = importer.current_date + timedelta(days = 1)
+                logger.info('Rolling over to %s'%next_date.strftime('%Y-%m-%d'))
+                importer.set_date(next_date.year, next_date.month, next_date.day)
+                downloader.set_date(next_date.year, next_date.month, next_date.day)
+                stale = True
+                delay = 0 # the parts of the new day right away
+                continue
+            delay = poll_interval
+        except Exception:
+            delay = min(max(delay, poll_interval) * 2, max_backoff)
+            logger.exception('Polling failed, trying again in %ss'%delay)
 
 if __name__ == '__main__':
     args = {}
@@ -38,10 +122,61 @@ if __name__ == '__main__':
         args[k.strip()] = v.strip()
     date_str = args.get('date')
     file_path = args.get('file_path')
+    importer_options = {}
+    # batch_activity=y gathers activity updates for the whole run
+    importer_options['batch_activity_updates'] = args.get('batch_activity', 'n').lower() == 'y'
+    if args.get('activity_flush_threshold') is not None:
+        importer_options['activity_flush_threshold'] = int(args['activity_flush_threshold'])
+    # bulk_day=y loads the day into a bare fact table and indexes it at the end
+    importer_options['bulk_day'] = args.get('bulk_day', 'n').lower() == 'y'
+    # materialized_times=y fills the time dimension by year, see prepopulate_times
+    importer_options['materialized_times'] = args.get('materialized_times', 'n').lower() == 'y'
+    # memory_budget_mb=N spills the largest dimensions to disk over N MB
+    if args.get('memory_budget_mb') is not None:
+        importer_options['memory_budget_mb'] = int(args['memory_budget_mb'])
+    # program_window_days=N only caches programs starting within N days
+    if args.get('program_window_days') is not None:
+        importer_options['program_window_days'] = int(args['program_window_days'])
+    # sessionize=y merges consecutive viewing segments, see sessionize_viewing_data
+    importer_options['sessionize'] = args.get('sessionize', 'n').lower() == 'y'
+    if args.get('session_gap_seconds') is not None:
+        importer_options['session_gap_seconds'] = int(args['session_gap_seconds'])
+    # reach_sketches=y keeps HyperLogLog reach sketches, see vizio_sketch
+    importer_options['reach_sketches'] = args.get('reach_sketches', 'n').lower() == 'y'
+    # fact_shards=N loads large fact batches over N connections
+    if args.get('fact_shards') is not None:
+        importer_options['fact_shards'] = int(args['fact_shards'])
+    # sample_rate=F imports a stable fraction F of the households
+    if args.get('sample_rate') is not None:
+        importer_options['sample_rate'] = float(args['sample_rate'])
+    # day_batch=y resolves the dimensions of all pending parts at once
+    importer_options['day_batch'] = args.get('day_batch', 'n').lower() == 'y'
+    # reject_dir=PATH is where rows failing validation are written
+    if args.get('reject_dir') is not None:
+        importer_options['reject_dir'] = args['reject_dir']
+    # household_filter=PATH keeps a Bloom filter of known households there
+    if args.get('household_filter') is not None:
+        importer_options['household_filter_path'] = args['household_filter']
+    # storage=sqlite runs against the embedded SQLite database of config.py
+    if args.get('storage') is not None:
+        importer_options['storage'] = args['storage'].lower()
+    # profile=cpu|mem profiles each import stage into the log directory
+    if args.get('profile') is not None:
+        importer_options['profile'] = args['profile'].lower()
+
+    if args.get('watch', 'n').lower() == 'y':
+        # watch=y runs as a daemon, see watch()
+        watch(file_path,
+              poll_interval = int(args.get('poll_interval', 300)),
+              grace_period = int(args.get('grace_period', 3600)),
+              max_failures = int(args.get('max_failures', 3)),
+              **importer_options)
+        sys.exit(0)
+
     if date_str is None:
         print "Date is not specified, running for the scrip for today's date"
         today = date.today()
         year, month, day = today.year, today.month, today.day
     else:
         year, month, day = [int(x) for x in date_str.split('-')]
-    main(year, month, day, file_path)
+    main(year, month, day, file_path, **importer_options)
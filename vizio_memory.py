@@ -0,0 +1,263 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from datetime import date, datetime
+from vizio_dimension import VizioDimension, key_hashes
+
+
+def used_memory_mb():
+    # Anonymous resident memory of this process. Pages of memory-mapped files
+    # are left out: the kernel can drop them without swapping.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    import resource
+    # peak resident set, in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class MemoryBudget(object):
+    # 1. Initiate class by MemoryBudget(budget_mb). budget_mb None means no limit.
+    # 2. exceeded() tells when dimensions should be spilled, report() for logs.
+
+    def __init__(self, budget_mb = None):
+        self.budget_mb = budget_mb
+
+    def used_mb(self):
+        return used_memory_mb()
+
+    def fraction(self):
+        if not self.budget_mb:
+            return None
+        return self.used_mb() / float(self.budget_mb)
+
+    def exceeded(self):
+        return bool(self.budget_mb) and self.used_mb() > self.budget_mb
+
+    def report(self):
+        used = self.used_mb()
+        if not self.budget_mb:
+            return 'Memory used {used:.0f} MB, no budget'.format(used = used)
+        return 'Memory used {used:.0f} MB of {budget} MB budget ({pct:.0f}%)'.format(
+            used   = used,
+            budget = self.budget_mb,
+            pct    = 100.0 * used / self.budget_mb
+        )
+
+
+class MmapDimension(object):
+    # A dimension frame spilled to memory-mapped files on local disk.
+    # Rows are kept sorted by the hash of their natural key (on), so a lookup
+    # is a binary search; only id and the numeric or date columns are kept,
+    # the key strings themselves are dropped. Rows appended after the spill
+    # stay in memory in self.delta until compact().
+    #
+    # Lookup API, shared with VizioDimension:
+    #   lookup(frame, columns)  - id and columns of the rows of frame, NaN if missing
+    #   contains(ids)           - boolean array, ids present in the dimension
+    #   append(rows)            - add rows (natural key, id and columns)
+    #   set_values(ids, column, value)
+    #   max_id(), len()
+
+    def __init__(self, frame, on, columns, spill_dir, name = 'dimension',
+                 datetime_cols = ()):
+        self.on      = on
+        self.columns = columns
+        self.datetime_cols = datetime_cols
+        self.name    = name
+        if not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+        self.spill_dir  = spill_dir
+        self.path       = None
+        self.date_cols  = set(
+            col for col in columns if self.holds_dates(frame[col])
+        )
+        self.delta = self.empty_delta(frame)
+        self.write(key_hashes(frame, on, datetime_cols),
+                   frame.id.values.astype(np.int64),
+                   dict((col, self.to_array(col, frame[col])) for col in columns))
+
+
+    def empty_delta(self, frame):
+        # rows appended after the spill, keyed by key_hash
+        delta = pd.DataFrame({'key_hash': np.array([], dtype = np.uint64),
+                              'id':       np.array([], dtype = np.int64)},
+                             columns = ['key_hash', 'id'])
+        for col in self.columns:
+            delta[col] = frame[col].iloc[:0]
+        return VizioDimension(delta, ['key_hash'], capacity = 256)
+
+
+    def holds_dates(self, values):
+        values = values.dropna()
+        return (values.dtype == object and len(values) > 0
+                and isinstance(values.iloc[0], date)
+                and not isinstance(values.iloc[0], datetime))
+
+
+    def to_array(self, col, values):
+        # dates and datetimes are stored as datetime64
+        if col in self.date_cols:
+            return pd.to_datetime(values).values.astype('datetime64[D]')
+        if values.dtype == object:
+            return pd.to_datetime(values).values
+        return values.values
+
+
+    def from_array(self, col, values):
+        if col in self.date_cols:
+            return pd.Series(pd.to_datetime(values)).dt.date.values
+        return values
+
+
+    def write(self, hashes, ids, values):
+        old_path  = self.path
+        self.path = tempfile.mkdtemp(prefix = '%s_'%self.name, dir = self.spill_dir)
+        order = np.argsort(hashes, kind = 'mergesort')
+        self.hashes = self.to_mmap('hashes', hashes[order])
+        self.ids    = self.to_mmap('id', ids[order])
+        self.values = dict(
+            (col, self.to_mmap(col, values[col][order])) for col in self.columns
+        )
+        id_order        = np.argsort(self.ids, kind = 'mergesort')
+        self.id_order   = self.to_mmap('id_order', id_order)
+        self.sorted_ids = self.to_mmap('sorted_ids', self.ids[id_order])
+        if old_path:
+            shutil.rmtree(old_path, ignore_errors = True)
+
+
+    def to_mmap(self, name, array):
+        filepath = os.path.join(self.path, name + '.npy')
+        np.save(filepath, array)
+        return np.load(filepath, mmap_mode = 'r+')
+
+
+    def search(self, sorted_values, values):
+        # positions of values in sorted_values, and whether they are there
+        if len(sorted_values) == 0:
+            return (np.zeros(len(values), dtype = np.int64),
+                    np.zeros(len(values), dtype = bool))
+        pos   = np.searchsorted(sorted_values, values)
+        pos   = np.minimum(pos, len(sorted_values) - 1)
+        found = sorted_values[pos] == values
+        return pos, found
+
+
+    def lookup(self, frame, columns = ()):
+        # DataFrame of id and columns aligned with frame
+        hashes = key_hashes(frame, self.on, self.datetime_cols)
+        pos, found = self.search(self.hashes, hashes)
+        missing = found == False
+        values  = {}
+        if len(self.ids):
+            ids = np.where(found, self.ids[pos], np.nan).astype(np.float64)
+            for col in columns:
+                values[col] = pd.Series(
+                    self.from_array(col, self.values[col][pos])
+                ).where(found).values
+        else:
+            # nothing on disk, every row is missing from the base
+            ids = np.full(len(hashes), np.nan)
+            for col in columns:
+                values[col] = np.array([None] * len(hashes), dtype = object)
+
+        if len(self.delta) and missing.any():
+            matched = self.delta.lookup(
+                pd.DataFrame({'key_hash': hashes[missing]}), columns
+            )
+            ids[missing] = matched.id.values.astype(np.float64)
+            for col in columns:
+                col_values = values[col].astype(object)
+                col_values[missing] = matched[col].values
+                values[col] = col_values
+
+        result = pd.DataFrame(values, index = frame.index, columns = list(columns))
+        result.insert(0, 'id', ids)
+        return result
+
+
+    def contains(self, ids):
+        ids = np.asarray(ids, dtype = np.float64)
+        _, found = self.search(self.sorted_ids,
+                               np.where(np.isnan(ids), -1, ids).astype(np.int64))
+        found &= np.isnan(ids) == False
+        if len(self.delta):
+            found |= self.delta.contains(ids)
+        return found
+
+
+    def append(self, rows):
+        new_rows = rows[['id'] + self.columns].copy()
+        new_rows['key_hash'] = key_hashes(rows, self.on, self.datetime_cols)
+        self.delta.append(new_rows)
+
+
+    def set_values(self, ids, column, value):
+        ids = np.asarray(ids, dtype = np.int64)
+        pos, found = self.search(self.sorted_ids, ids)
+        base_pos = self.id_order[pos[found]]
+        self.values[column][base_pos] = self.to_array(
+            column, pd.Series([value for _ in range(len(base_pos))], dtype = object)
+        )
+        if len(self.delta):
+            self.delta.set_values(ids, column, value)
+
+
+    def column(self, col):
+        # values of a stored column, base rows first then delta rows
+        return np.concatenate([
+            self.from_array(col, np.asarray(self.values[col])),
+            self.delta.column(col)
+        ])
+
+
+    def take(self, mask):
+        # keep the rows where mask (over column() order) is True
+        mask  = np.asarray(mask, dtype = bool)
+        base  = mask[:len(self.ids)]
+        self.delta.take(mask[len(self.ids):])
+        self.write(np.asarray(self.hashes)[base],
+                   np.asarray(self.ids)[base],
+                   dict((col, np.asarray(self.values[col])[base]) for col in self.columns))
+
+
+    def compact(self):
+        # move the delta rows to disk
+        if not len(self.delta):
+            return
+        delta = self.delta.frame()
+        self.delta.take(np.zeros(len(delta), dtype = bool))
+        self.write(
+            np.concatenate([self.hashes, delta.key_hash.values.astype(np.uint64)]),
+            np.concatenate([self.ids, delta.id.values.astype(np.int64)]),
+            dict((col, np.concatenate([self.values[col],
+                                       self.to_array(col, delta[col])]))
+                 for col in self.columns)
+        )
+
+
+    def max_id(self):
+        ids = [int(self.ids.max())] if len(self.ids) else []
+        if len(self.delta):
+            ids.append(self.delta.max_id())
+        return max(ids) if ids else None
+
+
+    def __len__(self):
+        return len(self.ids) + len(self.delta)
+
+
+    def release(self):
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors = True)
+            self.path = None
+
+
+    def __del__(self):
+        self.release()
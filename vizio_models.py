@@ -1,40 +1,63 @@
-from sqlalchemy.schema import ForeignKeyConstraint, UniqueConstraint
+from sqlalchemy.schema import ForeignKeyConstraint, UniqueConstraint, Index
 from vizio_table_mixin import VizioViewingFactMixin, VizioDemographicDimMixin, \
                               VizioLocationDimMixin, VizioNetworkDimMixin, \
                               VizioProgramDimMixin, VizioTimeDimMixin, \
-                              VizioActivityDimMixin, VizioFileInfoMixin
+                              VizioActivityDimMixin, VizioFileInfoMixin, \
+                              VizioReachSketchMixin
 
 
-def VizioViewingFact(Base, year, month, day):
+# Secondary indexes of the daily fact table
+VIEWING_FACT_INDEXES = ['viewing_start_time', 'viewing_end_time']
+
+# Rows of a file are replaced by source_file_id, so this one is there even
+# on a deferred table
+VIEWING_FACT_SOURCE_INDEX = 'source_file_id'
+
+
+def viewing_fact_index_name(table_name, column):
+    # Same name sqlalchemy gives to Column(index=True)
+    return 'ix_{table_name}_{column}'.format(table_name=table_name, column=column)
+
+
+def viewing_fact_foreign_keys(year, month):
+    # (columns, referred columns) of the daily fact table
     month = "{:02d}".format(month)
-    day = "{:02d}".format(day)
+    return [
+        (['demographic_key'],
+         ['vizio_demographic_dim_{year}_{month}.id'.format(year=year, month=month)]),
+        (['location_key'], ['vizio_location_dim.id']),
+        (['network_key'], ['vizio_network_dim.id']),
+        (['program_key'], ['vizio_program_dim.id']),
+        (['time_key'], ['vizio_time_dim.id']),
+        (['local_time_key'], ['vizio_time_dim.id'])
+    ]
+
+
+def VizioViewingFact(Base, year, month, day, deferred=False):
+    # deferred=True declares the table bare, without foreign keys and indexes
+    # other than the source_file_id one.
+    # The rest are built after the day is loaded (VizioDBConnection.build_viewing_constraints)
+    table_name = 'vizio_viewing_fact_{year}_{month}_{day}'.format(
+        year=year, month="{:02d}".format(month), day="{:02d}".format(day)
+    )
+    source_index = Index(viewing_fact_index_name(table_name, VIEWING_FACT_SOURCE_INDEX),
+                         VIEWING_FACT_SOURCE_INDEX)
+    if deferred:
+        table_args = (source_index, )
+    else:
+        table_args = tuple(
+            [ForeignKeyConstraint(columns, refcolumns)
+             for columns, refcolumns in viewing_fact_foreign_keys(year, month)] +
+            [Index(viewing_fact_index_name(table_name, column), column)
+             for column in VIEWING_FACT_INDEXES] +
+            [source_index]
+        )
 
     ## Class declaration
     class VizioViewingFactObj(VizioViewingFactMixin, Base):
 
-        __tablename__ = 'vizio_viewing_fact_{year}_{month}_{day}'.format(year=year, month=month, day=day)
-        __table_args__ = (
-            ForeignKeyConstraint(
-                ['demographic_key'],
-                ['vizio_demographic_dim_{year}_{month}.id'.format(year=year, month=month)]
-            ),
-            ForeignKeyConstraint(
-                ['location_key'],
-                ['vizio_location_dim.id']
-            ),
-            ForeignKeyConstraint(
-                ['network_key'],
-                ['vizio_network_dim.id']
-            ),
-            ForeignKeyConstraint(
-                ['program_key'],
-                ['vizio_program_dim.id']
-            ),
-            ForeignKeyConstraint(
-                ['time_key'],
-                ['vizio_time_dim.id']
-            )
-        )
+        __tablename__ = table_name
+        __table_args__ = table_args
     ## end of Class declaration
 
     return VizioViewingFactObj
@@ -122,3 +145,16 @@ def VizioFileInfo(Base):
     ## end of Class declaration
 
     return VizioFileInfoObj
+
+
+def VizioReachSketch(Base):
+
+    ## Class declaration
+    class VizioReachSketchObj(VizioReachSketchMixin, Base):
+        __tablename__ = 'vizio_reach_sketch'
+        __table_args__ = (
+            UniqueConstraint('sketch_date', 'dimension', 'dimension_key'),
+        )
+    ## end of Class declaration
+
+    return VizioReachSketchObj
@@ -0,0 +1,140 @@
+import os
+import cProfile
+import pstats
+import threading
+from time import time
+from contextlib import contextmanager
+from datetime import datetime
+from vizio_memory import used_memory_mb
+from local_logger import LocalLogger
+
+# standard in Python 3.4+, the pytracemalloc backport on Python 2
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+profile_logger = LocalLogger(
+            logger_name = __name__,
+            logfile = 'vizio_profile_{0}.log'.format(
+                datetime.today().strftime(LocalLogger.date_suffix_fmt)
+            )
+        )
+logger = profile_logger.logger
+
+PROFILE_MODES = ['cpu', 'mem']
+
+
+class VizioProfiler(object):
+    # Opt-in profiling of import runs, written next to the logs.
+    # 1. Initiate class by VizioProfiler(mode), mode 'cpu', 'mem' or None
+    # 2. with profiler.stage(name, label): around each stage of a file
+    # 3. profiler.snapshot(name, label) at points of interest within one
+    #
+    # cpu: each stage runs under its own cProfile, dumped to
+    #      <label>.<stage>.prof. pstats, snakeviz, gprof2dot and flameprof
+    #      read these. Stages do not nest, cProfile only runs one at a time.
+    #      cProfile only sees its own thread, so threads started during the
+    #      stage (to_thread, run_parallel) get one each through
+    #      threading.setprofile, added to the same file. The stage waits for
+    #      them to finish before they are added, so writers still running at
+    #      its end are profiled in full. Threads started before the stage
+    #      are not profiled.
+    # mem: tracemalloc snapshots at the start and end of each stage and at
+    #      every snapshot(), dumped to <label>.<n>.<name>.snap (load with
+    #      tracemalloc.Snapshot.load); the largest growths since the last
+    #      snapshot are logged. Without tracemalloc only resident memory is.
+    # Disabled (mode None), stage() and snapshot() do nothing.
+
+    def __init__(self, mode = None, output_dir = None):
+        if mode is not None and mode not in PROFILE_MODES:
+            raise ValueError('Unknown profile mode %s'%mode)
+        self.mode = mode
+        self.output_dir = output_dir or os.path.join(profile_logger.logdir, 'profiles')
+        self.snapshots  = 0
+        self.last_snapshot = None
+        if self.mode is None:
+            return
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        if self.mode == 'mem':
+            if tracemalloc is None:
+                logger.warning('tracemalloc is not available, logging resident memory only')
+            elif not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+        logger.info('Profiling %s to %s'%(self.mode, self.output_dir))
+
+
+    def output_path(self, label, name, ext):
+        label = os.path.basename(str(label))
+        return os.path.join(self.output_dir, '%s.%s.%s'%(label, name, ext))
+
+
+    @contextmanager
+    def stage(self, name, label):
+        if self.mode is None:
+            yield
+            return
+        start = time()
+        if self.mode == 'cpu':
+            profile = cProfile.Profile()
+            thread_profiles = []
+            threading.setprofile(self.thread_profiler(thread_profiles))
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                threading.setprofile(None)
+                # wait for the threads of the stage, a running one still
+                # adds to its profile
+                for thread, _ in thread_profiles:
+                    thread.join()
+                stats = pstats.Stats(profile)
+                for _, thread_profile in thread_profiles:
+                    stats.add(thread_profile)
+                filepath = self.output_path(label, name, 'prof')
+                stats.dump_stats(filepath)
+                logger.info('%s of %s took %.1fs, profile in %s'%(name, label,
+                                                                 time() - start,
+                                                                 filepath))
+        else:
+            self.snapshot('start_' + name, label)
+            try:
+                yield
+            finally:
+                self.snapshot('end_' + name, label)
+                logger.info('%s of %s took %.1fs'%(name, label, time() - start))
+
+
+    def thread_profiler(self, profiles):
+        # Profile function of the threads started during a stage. On the
+        # first event of a thread it hands over to a cProfile of its own.
+        def start(frame, event, arg):
+            profile = cProfile.Profile()
+            profiles.append((threading.current_thread(), profile))
+            profile.enable()
+        return start
+
+
+    def snapshot(self, name, label):
+        if self.mode != 'mem':
+            return
+        self.snapshots += 1
+        logger.info('%s of %s: %.0f MB resident'%(name, label, used_memory_mb()))
+        if tracemalloc is None:
+            return
+        # leave out the allocations of tracemalloc itself
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<unknown>')
+        ])
+        snapshot.dump(self.output_path(label, '%03d.%s'%(self.snapshots, name), 'snap'))
+        current, peak = tracemalloc.get_traced_memory()
+        logger.info('%s of %s: %.0f MB traced, %.0f MB peak'%(name, label,
+                                                             current / 1048576.0,
+                                                             peak / 1048576.0))
+        if self.last_snapshot is not None:
+            for stat in snapshot.compare_to(self.last_snapshot, 'lineno')[:10]:
+                logger.info('  %s'%stat)
+        self.last_snapshot = snapshot
@@ -0,0 +1,134 @@
+import os
+import json
+from datetime import datetime
+from local_logger import LocalLogger
+
+logger = LocalLogger(
+            logger_name = __name__,
+            logfile = 'vizio_s3_index_{0}.log'.format(
+                datetime.today().strftime(LocalLogger.date_suffix_fmt)
+            )
+        ).logger
+
+
+class VizioS3Index(object):
+    # Local persistent index of the remote keys under one S3 prefix.
+    # 1. Initiate class by VizioS3Index(bucket, prefix, index_path)
+    # 2. refresh() picks up new keys and parts changed according to manifests
+    # 3. changed_keys() are the keys to download, mark_downloaded() after.
+    #
+    # Each key keeps etag, size and last_modified from S3, and the etag
+    # of the copy we downloaded. A re-delivered part gets a new etag under
+    # the same name, so it shows up in changed_keys() again.
+
+    def __init__(self, bucket, prefix, index_path):
+        self.bucket     = bucket
+        self.prefix     = prefix
+        self.index_path = index_path
+
+        # S3 lists keys in lexicographic order, so the last seen key is where
+        # the next listing resumes.
+        self.last_key = None
+        self.keys     = {}
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                saved = json.load(f)
+            self.last_key = saved.get('last_key')
+            self.keys     = saved.get('keys', {})
+
+
+    def refresh(self):
+        # Returns the names of keys that are new or changed since last refresh
+        changed = []
+
+        # New keys, listed from the last seen key onwards
+        for key in self.bucket.list(prefix = self.prefix,
+                                    marker = self.last_key or ''):
+            self.last_key = key.name
+            if self.record(key):
+                changed.append(key.name)
+
+        # Keys already listed can only be re-delivered; the manifests say so.
+        for name in self.manifest_names():
+            manifest = self.bucket.get_key(name)
+            if manifest is None:
+                continue
+            manifest_changed = self.record(manifest)
+            if not manifest_changed and name not in changed:
+                continue
+            for part_name in self.parse_manifest(manifest):
+                part = self.bucket.get_key(part_name)
+                if part is not None and self.record(part):
+                    changed.append(part_name)
+            if name not in changed:
+                changed.append(name)
+
+        self.save()
+        if changed:
+            logger.info('%s new or changed keys under %s'%(len(changed), self.prefix))
+        return changed
+
+
+    def record(self, key):
+        # Store the listing metadata of a key. True if it is new or changed.
+        etag = key.etag.strip('"') if key.etag else None
+        entry = self.keys.get(key.name)
+        if entry is not None and entry['etag'] == etag:
+            return False
+        if entry is None:
+            entry = {'downloaded_etag': None}
+            self.keys[key.name] = entry
+        entry['etag']          = etag
+        entry['size']          = key.size
+        entry['last_modified'] = key.last_modified
+        return True
+
+
+    def parse_manifest(self, manifest):
+        # Redshift UNLOAD manifest:
+        #   {"entries": [{"url": "s3://bucket/vizio/...part_00.gz"}, ...]}
+        try:
+            entries = json.loads(manifest.get_contents_as_string())['entries']
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning('Cannot parse manifest %s - %s'%(manifest.name, e))
+            return []
+        bucket_url = 's3://%s/'%self.bucket.name
+        part_names = []
+        for entry in entries:
+            url = entry.get('url', '')
+            if url.startswith(bucket_url):
+                part_names.append(url[len(bucket_url):])
+        return part_names
+
+
+    def manifest_names(self):
+        return sorted(name for name in self.keys if name.find('_manifest') != -1)
+
+
+    def changed_keys(self):
+        # Keys whose remote copy differs from the downloaded one
+        return sorted(
+            name for name, entry in self.keys.items()
+            if entry['etag'] != entry['downloaded_etag']
+        )
+
+
+    def is_redelivery(self, name):
+        return self.keys[name]['downloaded_etag'] is not None
+
+
+    def mark_downloaded(self, names):
+        for name in names:
+            self.keys[name]['downloaded_etag'] = self.keys[name]['etag']
+        self.save()
+
+
+    def save(self):
+        # Write to a temp file first so a crash never leaves half an index
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'last_key': self.last_key, 'keys': self.keys}, f)
+        os.rename(temp_path, self.index_path)
@@ -0,0 +1,238 @@
+import os
+import math
+import zlib
+import numpy as np
+import pandas as pd
+
+# 2**12 one-byte registers, about 1.6% standard error
+SKETCH_PRECISION = 12
+
+# dimension name -> fact column the sketches are keyed by. Network and
+# program sketches are per date, time_key already is a (date, time_slot).
+SKETCH_DIMENSIONS = {
+    'network': 'network_key',
+    'program': 'program_key',
+    'time':    'time_key'
+}
+
+
+def bit_length(values):
+    # number of bits of each uint64, 0 for 0
+    values = values.copy()
+    length = np.zeros(len(values), dtype = np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        big = values >= (np.uint64(1) << np.uint64(shift))
+        length[big] += shift
+        values[big] >>= np.uint64(shift)
+    return length + (values > 0)
+
+
+def hash_keys(values):
+    return pd.util.hash_array(np.asarray(values, dtype = np.int64)).astype(np.uint64)
+
+
+def hash_strings(values, hash_key):
+    # 64 bit hash of each string, one independent hash per 16 character key
+    return pd.util.hash_array(np.asarray(values, dtype = object),
+                              hash_key = hash_key,
+                              categorize = False).astype(np.uint64)
+
+
+def register_ranks(hashes, precision = SKETCH_PRECISION):
+    # (register index, rank) of each hash. The first precision bits pick
+    # the register, the rank is the position of the first 1 in the rest.
+    rest_bits = 64 - precision
+    index = (hashes >> np.uint64(rest_bits)).astype(np.int64)
+    rest  = hashes & np.uint64((1 << rest_bits) - 1)
+    rank  = rest_bits - bit_length(rest) + 1
+    return index, rank.astype(np.uint8)
+
+
+class HyperLogLog(object):
+    # Mergeable distinct count sketch.
+    # 1. Initiate class by HyperLogLog() or HyperLogLog.from_bytes(blob)
+    # 2. update(values), merge(other), count()
+
+    def __init__(self, registers = None, precision = SKETCH_PRECISION):
+        self.precision = precision
+        if registers is None:
+            registers = np.zeros(1 << precision, dtype = np.uint8)
+        self.registers = registers
+
+
+    def update(self, values):
+        index, rank = register_ranks(hash_keys(values), self.precision)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out = self.registers)
+        return self
+
+
+    def count(self):
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = int((self.registers == 0).sum())
+        if estimate <= 2.5 * m and zeros:
+            # small range correction, linear counting
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+
+    def to_bytes(self):
+        return zlib.compress(self.registers.tobytes())
+
+
+    @classmethod
+    def from_bytes(cls, blob, precision = SKETCH_PRECISION):
+        registers = np.frombuffer(zlib.decompress(blob), dtype = np.uint8).copy()
+        return cls(registers, precision)
+
+
+class VizioReachSketches(object):
+    # HyperLogLog sketches of demographic_key for one date, per network_key,
+    # program_key and time_key (see SKETCH_DIMENSIONS).
+    # 1. load() rows of vizio_reach_sketch for the date
+    # 2. update() with the fact rows of each file
+    # 3. VizioDBConnection.flush_sketches() writes the changed ones and
+    #    calls written()
+
+    def __init__(self, sketch_date, precision = SKETCH_PRECISION):
+        self.sketch_date = sketch_date
+        self.precision   = precision
+        self.sketches    = {} # (dimension, dimension_key) -> HyperLogLog
+        self.pending     = set()
+
+
+    def load(self, rows):
+        # rows are (dimension, dimension_key, registers)
+        for dimension, dimension_key, registers in rows:
+            self.sketches[(dimension, dimension_key)] = HyperLogLog.from_bytes(
+                registers, self.precision
+            )
+
+
+    def update(self, facts):
+        # One groupby per dimension, sketches are only touched per register
+        households = facts.demographic_key
+        index, rank = register_ranks(hash_keys(households.values), self.precision)
+        for dimension, column in SKETCH_DIMENSIONS.items():
+            registers = pd.DataFrame({'key':   facts[column].values,
+                                      'index': index,
+                                      'rank':  rank}).dropna()
+            if len(registers) == 0:
+                continue
+            registers = registers.groupby(['key', 'index'])['rank'].max().reset_index()
+            for key, group in registers.groupby('key'):
+                sketch_key = (dimension, int(key))
+                sketch = self.sketches.get(sketch_key)
+                if sketch is None:
+                    sketch = HyperLogLog(precision = self.precision)
+                    self.sketches[sketch_key] = sketch
+                np.maximum.at(sketch.registers,
+                              group['index'].values.astype(np.int64),
+                              group['rank'].values.astype(np.uint8))
+                self.pending.add(sketch_key)
+
+
+    def pending_rows(self):
+        return [{'sketch_date':   self.sketch_date,
+                 'dimension':     dimension,
+                 'dimension_key': dimension_key,
+                 'registers':     self.sketches[(dimension, dimension_key)].to_bytes()}
+                for dimension, dimension_key in sorted(self.pending)]
+
+
+    def written(self):
+        self.pending = set()
+
+
+class BloomFilter(object):
+    # Set membership with false positives but no false negatives: contains()
+    # is False only for values that were never added.
+    # 1. Initiate class by BloomFilter.for_capacity(n) or BloomFilter.load(path)
+    # 2. add(values), contains(values), save(path)
+    #
+    # The num_hashes bits of a value are (h1 + i * h2) mod num_bits from two
+    # 64 bit hashes. Past capacity values the false positive rate goes over
+    # error_rate; count tells when (duplicates added are counted too).
+
+    hash_keys = ('vizio_bloom_h1__', 'vizio_bloom_h2__')
+
+    def __init__(self, num_bits, num_hashes, capacity, bits = None, count = 0):
+        self.num_bits   = num_bits
+        self.num_hashes = num_hashes
+        self.capacity   = capacity
+        if bits is None:
+            bits = np.zeros((num_bits + 7) // 8, dtype = np.uint8)
+        self.bits  = bits
+        self.count = count
+
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate = 0.01):
+        capacity   = max(1, int(capacity))
+        num_bits   = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        num_hashes = max(1, int(round(num_bits / float(capacity) * math.log(2))))
+        return cls(num_bits, num_hashes, capacity)
+
+
+    def positions(self, values):
+        # bit positions of the values, one array per hash. One hash at a
+        # time keeps the temporaries at the size of values.
+        num_bits = np.uint64(self.num_bits)
+        h1 = (hash_strings(values, self.hash_keys[0]) % num_bits).astype(np.int64)
+        h2 = (hash_strings(values, self.hash_keys[1]) % num_bits).astype(np.int64)
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+
+    def add(self, values):
+        if len(values) == 0:
+            return self
+        for positions in self.positions(values):
+            np.bitwise_or.at(self.bits,
+                             positions >> 3,
+                             np.left_shift(1, positions & 7).astype(np.uint8))
+        self.count += len(values)
+        return self
+
+
+    def contains(self, values):
+        found = np.ones(len(values), dtype = bool)
+        if len(values) == 0:
+            return found
+        for positions in self.positions(values):
+            found &= (self.bits[positions >> 3] >> (positions & 7)) & 1 == 1
+        return found
+
+
+    def full(self):
+        return self.count > self.capacity
+
+
+    def save(self, path, **info):
+        # bits and sizes in one .npz, plus info integers given by the caller.
+        # Written aside and renamed, so a crash never leaves half a file.
+        tmp_path = path + '.tmp.npz'
+        params = dict(('info_' + key, np.int64(value)) for key, value in info.items())
+        np.savez(tmp_path,
+                 bits   = self.bits,
+                 params = np.array([self.num_bits, self.num_hashes,
+                                    self.capacity, self.count], dtype = np.int64),
+                 **params)
+        os.rename(tmp_path, path)
+
+
+    @classmethod
+    def load(cls, path):
+        # (BloomFilter, info dict) of a file written by save()
+        with np.load(path) as data:
+            num_bits, num_hashes, capacity, count = [int(x) for x in data['params']]
+            bloom = cls(num_bits, num_hashes, capacity, data['bits'].copy(), count)
+            info  = dict((key[len('info_'):], int(data[key]))
+                         for key in data.files if key.startswith('info_'))
+        return bloom, info
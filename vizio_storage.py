@@ -0,0 +1,322 @@
+import os
+from uuid import uuid4
+from contextlib import contextmanager
+from datetime import datetime, date
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, event, text
+from local_logger import LocalLogger
+
+logger = LocalLogger(
+            logger_name = __name__,
+            logfile = 'vizio_storage_{0}.log'.format(
+                datetime.today().strftime(LocalLogger.date_suffix_fmt)
+            )
+        ).logger
+
+
+class VizioStorage(object):
+    # Storage backend under VizioDBConnection: the engine and the bulk write
+    # paths. The load_* queries and the fileinfo writes are SQLAlchemy and
+    # run on any engine; the bulk paths are specific to each backend.
+    # 1. Initiate class by storage_backend(name, config)
+    # 2. create_engine() once, then the write methods below, from any thread
+    #
+    # Every backend implements:
+    #   create_engine()
+    #   insert_rows(table_obj, pd_df)     - append rows to a table
+    #   load_viewing_rows(table_obj, table_name, pd_df, source_file_id)
+    #                                     - fact rows, skipping ids already
+    #                                       there; rows of source_file_id are
+    #                                       deleted in the same transaction.
+    #                                       False when the load failed.
+    #   update_activity(table_obj, pd_df) - last_active_date of (id, last_active_date) rows
+    #   upsert_sketches(session, table_obj, rows)
+    #   add_viewing_constraints(session, table_name, indexes, foreign_keys)
+    #                                     - indexes are (index_name, column),
+    #                                       foreign_keys (column, ref_table, ref_column)
+    #
+    # insert_rows and update_activity raise when the write fails; they run on
+    # the threads of VizioDBConnection.to_thread, which hands the error to
+    # join_threads.
+
+    name = None
+
+    def __init__(self, config):
+        self.config = config
+        self.engine = None
+
+
+class VizioMySQLStorage(VizioStorage):
+    # MySQL server of config.CONNECTIONS['vizio']. Bulk writes go through
+    # csv files and LOAD DATA in the vizio_*_script.sh shell scripts.
+
+    name = 'mysql'
+
+    def create_engine(self):
+        self.engine = create_engine(
+            "mysql+mysqldb://{user}:{password}@{host}:{port}/{database}".format(
+                **self.config.CONNECTIONS['vizio']
+            )
+        )
+        return self.engine
+
+
+    def run_script(self, command):
+        # mysql stops at the first failing statement and exits non-zero
+        if os.system(command) != 0:
+            raise IOError('Failed: %s'%command)
+
+
+    def insert_rows(self, table_obj, pd_df):
+        # use external shell script to do the insertion.
+        unique_filepath = self.table_csv(table_obj, pd_df)
+        self.run_script(
+            './vizio_data_import_script.sh {file_name} {table_name}'.format(
+                file_name  = unique_filepath,
+                table_name = table_obj.__tablename__)
+        )
+
+
+    def load_viewing_rows(self, table_obj, table_name, pd_df, source_file_id = None):
+        unique_filepath = self.table_csv(table_obj, pd_df)
+        command = './vizio_viewing_load_script.sh {file_name} {table_name}'.format(
+            file_name  = unique_filepath,
+            table_name = table_name)
+        if source_file_id is not None:
+            command += ' %s'%int(source_file_id)
+        return os.system(command) == 0
+
+
+    def update_activity(self, table_obj, pd_df):
+        unique_filepath = self.to_csv(pd_df, './vizio_temp/activity_to_update')
+        self.run_script(
+            './vizio_activity_update_script.sh {file_name}'.format(
+                file_name = unique_filepath)
+        )
+
+
+    def upsert_sketches(self, session, table_obj, rows):
+        session.execute(
+            text('INSERT INTO {table_name} '
+                 '(sketch_date, dimension, dimension_key, registers) '
+                 'VALUES (:sketch_date, :dimension, :dimension_key, :registers) '
+                 'ON DUPLICATE KEY UPDATE registers = VALUES(registers)'.format(
+                     table_name = table_obj.__tablename__)),
+            rows
+        )
+
+
+    def add_viewing_constraints(self, session, table_name, indexes, foreign_keys):
+        # Indexes and foreign keys in one ALTER TABLE
+        clauses = []
+        for index_name, column in indexes:
+            clauses.append('ADD INDEX {index_name} ({column})'.format(
+                index_name = index_name,
+                column     = column))
+        for column, ref_table, ref_column in foreign_keys:
+            clauses.append(
+                'ADD FOREIGN KEY ({column}) REFERENCES {ref_table} ({ref_column})'.format(
+                    column     = column,
+                    ref_table  = ref_table,
+                    ref_column = ref_column))
+        if not clauses:
+            return
+
+        # keys were already checked in memory by check_viewing_keys
+        session.execute('SET foreign_key_checks=0')
+        session.execute(
+            'ALTER TABLE {table_name} {clauses}'.format(
+                table_name = table_name,
+                clauses    = ', '.join(clauses))
+        )
+        session.execute('SET foreign_key_checks=1')
+
+
+    def table_csv(self, table_obj, pd_df):
+        # csv with the columns of the table, in order
+        def __put_placeholder(pd_df, columns):
+            for col in columns:
+                if col not in pd_df.columns:
+                    pd_df[col] = [None for _ in range(len(pd_df))]
+            return pd_df[columns]
+        table_cols = [col.key for col in table_obj.__table__.c]
+        filepath = './vizio_temp/%s_to_insert'%table_obj.__tablename__
+        return self.to_csv(__put_placeholder(pd_df, table_cols), filepath)
+
+
+    def to_csv(self, pd_df, filepath):
+        # save locally to be used by shell script to run file upload to database.
+        unique_filepath = filepath + '_' + uuid4().hex
+        pd_df.to_csv(unique_filepath,
+                     index = False,
+                     header = False,
+                     sep = '^',
+                     na_rep = '\N')
+        return unique_filepath
+
+
+# datetimes as SQLAlchemy stores them on SQLite
+SQLITE_DATETIME_FMT = '%Y-%m-%d %H:%M:%S.%f'
+SQLITE_MAX_INT = 2 ** 63 - 1
+
+
+def sqlite_values(values):
+    # Values of a column as sqlite3 binds them: None for nulls, datetimes
+    # and dates as the strings SQLAlchemy writes (so they compare alike),
+    # uint64 (row_fingerprint) as the signed integer of the same bits.
+    kind = values.dtype.kind
+    if kind == 'M':
+        return [None if pd.isnull(x) else x.strftime(SQLITE_DATETIME_FMT)
+                for x in values]
+    if kind == 'u' and values.dtype.itemsize == 8:
+        return values.values.astype(np.int64).tolist()
+    if kind in 'iub':
+        return values.tolist()
+    if kind == 'f':
+        return [None if x != x else x for x in values.tolist()]
+    return [sqlite_value(x) for x in values]
+
+
+def sqlite_value(x):
+    if isinstance(x, np.generic):
+        x = x.item()
+    if x is None or x is pd.NaT or (isinstance(x, float) and x != x):
+        return None
+    if isinstance(x, datetime):
+        return x.strftime(SQLITE_DATETIME_FMT)
+    if isinstance(x, date):
+        return x.isoformat()
+    if isinstance(x, (int, long)) and x > SQLITE_MAX_INT:
+        return x - 2 ** 64
+    return x
+
+
+class VizioSQLiteStorage(VizioStorage):
+    # Embedded SQLite database at config.CONNECTIONS['vizio_sqlite']['path'],
+    # for local runs and benchmarks without a MySQL server. Bulk writes are
+    # one executemany per batch in a single transaction.
+    #
+    # Writer threads wait for each other on the database lock (busy_timeout
+    # seconds); WAL lets readers go on meanwhile. SQLite cannot add foreign
+    # keys to an existing table, so bulk-day tables only get their indexes.
+
+    name = 'sqlite'
+    busy_timeout = 300
+
+    def create_engine(self):
+        path = self.config.CONNECTIONS['vizio_sqlite']['path']
+        self.engine = create_engine(
+            'sqlite:///{path}'.format(path = path),
+            connect_args = {'timeout':           self.busy_timeout,
+                            'check_same_thread': False}
+        )
+        event.listen(self.engine, 'connect', self.on_connect)
+        return self.engine
+
+
+    def on_connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+
+    @contextmanager
+    def transaction(self):
+        # cursor of a transaction, committed unless the block raises
+        connection = self.engine.raw_connection()
+        try:
+            yield connection.cursor()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+
+    def executemany(self, statements):
+        # (sql, rows) statements in one transaction
+        with self.transaction() as cursor:
+            for sql, rows in statements:
+                cursor.executemany(sql, rows)
+
+
+    def insert_statement(self, table_obj, table_name, pd_df, verb = 'INSERT'):
+        # Columns of the table found in pd_df, the others are left NULL
+        columns = [col.key for col in table_obj.__table__.c if col.key in pd_df.columns]
+        sql = '{verb} INTO {table_name} ({columns}) VALUES ({params})'.format(
+            verb       = verb,
+            table_name = table_name,
+            columns    = ', '.join(columns),
+            params     = ', '.join('?' for _ in columns))
+        rows = zip(*[sqlite_values(pd_df[col]) for col in columns])
+        return sql, rows
+
+
+    def insert_rows(self, table_obj, pd_df):
+        self.executemany([
+            self.insert_statement(table_obj, table_obj.__tablename__, pd_df)
+        ])
+
+
+    def load_viewing_rows(self, table_obj, table_name, pd_df, source_file_id = None):
+        # Rows whose id is already there are skipped, like the MySQL script.
+        # Not OR IGNORE, which would also drop rows breaking a NOT NULL.
+        try:
+            with self.transaction() as cursor:
+                if source_file_id is not None:
+                    cursor.execute('DELETE FROM {table_name} WHERE source_file_id = ?'.format(
+                        table_name = table_name), (int(source_file_id), ))
+                if len(pd_df):
+                    cursor.execute('SELECT id FROM {table_name} WHERE id BETWEEN ? AND ?'.format(
+                        table_name = table_name),
+                        (int(pd_df.id.min()), int(pd_df.id.max())))
+                    existing = [row[0] for row in cursor.fetchall()]
+                    if existing:
+                        pd_df = pd_df.loc[pd_df.id.isin(existing) == False]
+                sql, rows = self.insert_statement(table_obj, table_name, pd_df)
+                cursor.executemany(sql, rows)
+        except self.engine.dialect.dbapi.Error as e:
+            logger.error('Loading %s rows to %s: %s'%(len(pd_df), table_name, e))
+            return False
+        return True
+
+
+    def update_activity(self, table_obj, pd_df):
+        self.executemany([(
+            'UPDATE {table_name} SET last_active_date = ? WHERE id = ?'.format(
+                table_name = table_obj.__tablename__),
+            zip(sqlite_values(pd_df.last_active_date), sqlite_values(pd_df.id))
+        )])
+
+
+    def upsert_sketches(self, session, table_obj, rows):
+        # (sketch_date, dimension, dimension_key) is unique
+        session.execute(table_obj.__table__.insert().prefix_with('OR REPLACE'), rows)
+
+
+    def add_viewing_constraints(self, session, table_name, indexes, foreign_keys):
+        for index_name, column in indexes:
+            session.execute(
+                'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({column})'.format(
+                    index_name = index_name,
+                    table_name = table_name,
+                    column     = column))
+        if foreign_keys:
+            logger.info('%s foreign keys of %s not added, SQLite cannot add them to a table'%(
+                len(foreign_keys), table_name))
+
+
+# storage=<name> of VizioDBConnection
+STORAGE_BACKENDS = {
+    VizioMySQLStorage.name:  VizioMySQLStorage,
+    VizioSQLiteStorage.name: VizioSQLiteStorage
+}
+
+
+def storage_backend(name, config):
+    if name not in STORAGE_BACKENDS:
+        raise ValueError('Unknown storage backend %s'%name)
+    return STORAGE_BACKENDS[name](config)
@@ -1,5 +1,8 @@
-from sqlalchemy import Column, Integer, String, DateTime, Interval
-from sqlalchemy.dialects.mysql import TINYINT, TIMESTAMP, DATETIME, DATE, INTEGER
+from sqlalchemy import Column, Integer, SmallInteger, String, DateTime, Interval, LargeBinary, Float
+from sqlalchemy.dialects.mysql import TINYINT, TIMESTAMP, DATETIME, DATE, INTEGER, BIGINT
+
+# TINYINT on MySQL, a plain small integer on the other backends (SQLite)
+TinyInteger = SmallInteger().with_variant(TINYINT(), 'mysql')
 
 class VizioViewingFactMixin():
     id                    = Column(Integer, primary_key=True, autoincrement=True)
@@ -8,10 +11,13 @@ class VizioViewingFactMixin():
     network_key           = Column(Integer, nullable=True)
     program_key           = Column(Integer, nullable=True)
     time_key              = Column(Integer, nullable=False)
+    local_time_key        = Column(Integer, nullable=True) # time_key in the location's time zone
     program_time_at_start = Column(Integer, nullable=False) # milliseconds
-    viewing_start_time    = Column(TIMESTAMP, nullable=False, index=True)
-    viewing_end_time      = Column(TIMESTAMP, nullable=False, index=True)
+    viewing_start_time    = Column(TIMESTAMP, nullable=False) # indexed, see vizio_models
+    viewing_end_time      = Column(TIMESTAMP, nullable=False) # indexed, see vizio_models
     viewing_duration      = Column(Integer, nullable=False) # seconds
+    source_file_id        = Column(Integer, nullable=True) # vizio_fileinfo.id, indexed
+    row_fingerprint       = Column(BIGINT(unsigned=True), nullable=True) # hash of the row
 
 
 class VizioDemographicDimMixin():
@@ -31,7 +37,7 @@ class VizioLocationDimMixin():
     zipcode               = Column(String(10), nullable=False)
     dma                   = Column(String(128), nullable=False) # dma_name
     timezone              = Column(String(30), nullable=True)
-    tz_offset             = Column(TINYINT, nullable=True) # hours
+    tz_offset             = Column(TinyInteger, nullable=True) # hours
 
 
 class VizioNetworkDimMixin():
@@ -56,11 +62,11 @@ class VizioProgramDimMixin():
 
 class VizioTimeDimMixin():
     id                    = Column(Integer, primary_key=True, autoincrement=True)
-    time_slot             = Column(TINYINT, nullable=False) # 1-48
+    time_slot             = Column(TinyInteger, nullable=False) # 1-48
     date                  = Column(DATE, nullable=False)
-    day_of_week           = Column(TINYINT, nullable=False)
-    week                  = Column(TINYINT, nullable=False)
-    quarter               = Column(TINYINT, nullable=False)
+    day_of_week           = Column(TinyInteger, nullable=False)
+    week                  = Column(TinyInteger, nullable=False)
+    quarter               = Column(TinyInteger, nullable=False)
 
 class VizioFileInfoMixin():
     id                    = Column(Integer, primary_key=True, autoincrement=True)
@@ -69,3 +75,11 @@ class VizioFileInfoMixin():
     downloaded_date       = Column(DATETIME, nullable=True)
     imported_date         = Column(DATETIME, nullable=True)
     revised_date          = Column(DATETIME, nullable=True)
+    sample_rate           = Column(Float(precision=53), nullable=True) # fraction of households, NULL for all; DOUBLE on MySQL
+
+class VizioReachSketchMixin():
+    id                    = Column(Integer, primary_key=True, autoincrement=True)
+    sketch_date           = Column(DATE, nullable=False)
+    dimension             = Column(String(20), nullable=False) # network, program or time
+    dimension_key         = Column(Integer, nullable=False)
+    registers             = Column(LargeBinary, nullable=False) # zlib, see vizio_sketch
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+# columns given in the Vizio data
+VIEWING_COLUMNS = [
+    'household_id',
+    'zipcode',
+    'dma',
+    'tms_id',
+    'program_name',
+    'program_start_time',
+    'call_sign',
+    'program_time_at_start',
+    'viewing_start_time',
+    'viewing_end_time'
+]
+
+# a fact row cannot be built without these
+REQUIRED_COLUMNS = [
+    'household_id',
+    'program_time_at_start',
+    'viewing_start_time',
+    'viewing_end_time'
+]
+
+# Every column is read as text, so nothing gets mangled while parsing
+# (leading zeros of zipcodes) and the reject files hold the values as they
+# were given; validate_viewing_data converts them.
+VIEWING_DTYPES = dict((col, str) for col in VIEWING_COLUMNS)
+
+# Formats of the timestamp columns. Values that do not match get a second,
+# format-inferring pass before they are rejected.
+TIMESTAMP_FORMATS = {
+    'program_start_time': '%Y-%m-%dT%H:%M:%SZ', # 2017-05-01T01:00:00Z
+    'viewing_start_time': '%Y-%m-%d %H:%M:%S',
+    'viewing_end_time':   '%Y-%m-%d %H:%M:%S'
+}
+TIMESTAMP_COLUMNS = sorted(TIMESTAMP_FORMATS)
+
+# up to 5 digits, sometimes written out as a float
+ZIPCODE_PATTERN = r'^\d{1,5}(?:\.0*)?$'
+
+# Reason codes of the reject files, several are joined with '|':
+#   missing_<column>      required column is empty
+#   bad_timestamp_<column> timestamp does not parse
+#   bad_zipcode           zipcode is not up to 5 digits
+#   bad_offset            program_time_at_start is not a number >= 0
+#   end_before_start      viewing_end_time < viewing_start_time
+REJECT_REASON = 'reject_reason'
+
+
+def read_viewing_data(filepath):
+    # The fixed 10 column layout of the Vizio content files, typed as in
+    # VIEWING_DTYPES. Gzipped parts are decompressed while they are parsed.
+    return pd.read_csv(filepath,
+                       names = VIEWING_COLUMNS,
+                       header = None,
+                       dtype = VIEWING_DTYPES,
+                       na_values = ['', 'null'],
+                       keep_default_na = False,
+                       compression = 'gzip' if filepath.endswith('.gz') else None,
+                       engine = 'c')
+
+
+def parse_timestamps(values, timestamp_format):
+    # Explicit format first; only the values it misses are inferred
+    parsed = pd.to_datetime(values, format = timestamp_format, errors = 'coerce')
+    retry  = parsed.isnull() & values.notnull()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(values[retry], errors = 'coerce')
+    return parsed
+
+
+def validate_viewing_data(raw):
+    # Checks and converts whole columns of a file read by read_viewing_data.
+    # Returns (viewing_data, rejects): the valid rows with proper types, and
+    # the invalid rows as read plus their reject_reason.
+    reasons = pd.DataFrame(index = raw.index)
+    data    = raw.copy()
+
+    for col in REQUIRED_COLUMNS:
+        reasons['missing_' + col] = raw[col].isnull()
+
+    for col in TIMESTAMP_COLUMNS:
+        data[col] = parse_timestamps(raw[col], TIMESTAMP_FORMATS[col])
+        reasons['bad_timestamp_' + col] = raw[col].notnull() & data[col].isnull()
+
+    # Zipcode, zero padded to 5 digits
+    zipcode = raw.zipcode.str.strip()
+    reasons['bad_zipcode'] = (
+        zipcode.notnull() &
+        (zipcode.str.contains(ZIPCODE_PATTERN, na = False) == False)
+    )
+    data['zipcode'] = zipcode.str.split('.').str[0].str.zfill(5).where(
+        reasons.bad_zipcode == False
+    )
+
+    # Offset into the program, milliseconds
+    data['program_time_at_start'] = pd.to_numeric(raw.program_time_at_start,
+                                                  errors = 'coerce')
+    reasons['bad_offset'] = (
+        raw.program_time_at_start.notnull() &
+        ((data.program_time_at_start >= 0) == False)
+    )
+
+    # Order of the viewing timestamps, NaT compares False
+    start = data.viewing_start_time
+    end   = data.viewing_end_time
+    reasons['end_before_start'] = end < start
+
+    bad = reasons.any(axis = 1).values
+    rejects = raw.loc[bad].copy()
+    rejects[REJECT_REASON] = reason_codes(reasons.loc[bad])
+
+    data = data.loc[bad == False].reset_index(drop = True)
+    data['program_time_at_start'] = data.program_time_at_start.astype(np.int64)
+    data['zipcode'] = data.zipcode.where(data.zipcode.notnull(), None)
+    return data, rejects
+
+
+def reason_codes(reasons):
+    # '|' joined names of the True columns of each row
+    codes = pd.Series('', index = reasons.index)
+    for col in reasons.columns:
+        codes = codes + np.where(reasons[col].values, col + '|', '')
+    return codes.str.rstrip('|')
@@ -0,0 +1,52 @@
+#!/bin/bash
+
+if [ "$#" -lt 2 ] || [ "$#" -gt 3 ]; then
+    echo "Wrong number of arguments to the import shell script."
+    exit 1
+fi
+
+csv_filename=$1
+db_name=$2
+
+# With a source_file_id, rows already loaded from that file are deleted in
+# the same transaction, so a file is either loaded once or not at all.
+delete_rows=""
+if [ "$#" -eq 3 ]; then
+    delete_rows="DELETE FROM $db_name WHERE source_file_id = $3 AND @load_warnings = 0;"
+fi
+
+# Rows are loaded to a temporary table first. LOAD DATA LOCAL turns bad
+# values into warnings, so any warning there leaves the table as it was and
+# fails the script. Fact rows come with their ids; rows whose id is already
+# there (a shard loaded twice) are skipped, nothing else is.
+output=$(mysql -ubenhong -N -B <<QUERY_INPUT
+USE vizio;
+SET SESSION sql_mode = 'STRICT_ALL_TABLES';
+SET foreign_key_checks=0;
+SET unique_checks=0;
+SET sql_log_bin=0;
+SET autocommit=0;
+CREATE TEMPORARY TABLE temp_to_load_viewing LIKE $db_name;
+LOAD DATA LOCAL INFILE '$csv_filename' INTO TABLE temp_to_load_viewing
+FIELDS TERMINATED BY '^'
+LINES TERMINATED BY '\n';
+GET DIAGNOSTICS @load_warnings = NUMBER;
+$delete_rows
+INSERT INTO $db_name
+SELECT New.* FROM temp_to_load_viewing AS New
+LEFT JOIN $db_name AS Original USING(id)
+WHERE Original.id IS NULL AND @load_warnings = 0;
+COMMIT;
+DROP TEMPORARY TABLE temp_to_load_viewing;
+SET sql_log_bin=1;
+SET unique_checks=1;
+SET foreign_key_checks=1;
+SET autocommit=1;
+SELECT @load_warnings;
+QUERY_INPUT
+) || exit 1
+
+if [ "$output" != "0" ]; then
+    echo "$output warnings loading $csv_filename into $db_name, nothing loaded."
+    exit 1
+fi